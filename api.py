@@ -26,8 +26,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import json
+import random
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 
 class APIException(Exception):
@@ -45,11 +52,32 @@ class ResponseError(APIException):
 class RequestError(APIException):
     pass
 
+class ActionFailed(APIException):
+    pass
+
 class BaseAPI(object):
     endpoint = 'https://api.digitalocean.com/v2/'
 
-    def __init__(self, token=None):
+    # Requests that are safe to send twice. POSTs only get retried when DO tells us it never looked at them (429).
+    IDEMPOTENT = {'GET', 'PUT', 'DELETE', 'HEAD'}
+
+    def __init__(self, token=None, retries=5, timeout=60, pool_size=16, endpoint=None):
         self.token = token
+        if endpoint is not None:
+            # mostly so it can be pointed at a fake server
+            self.endpoint = endpoint
+        self.retries = retries
+        self.timeout = timeout
+
+        # One session for everything, so connections get reused instead of paying for a TLS handshake on every poll
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # When DO says we're out of requests, everyone waits until this time
+        self.rate_limit_lock = threading.Lock()
+        self.rate_limited_until = 0
 
     def __str__(self):
         return b'<{:s} at {:#x}>'.format(type(self).__name__, id(self))
@@ -67,22 +95,22 @@ class BaseAPI(object):
         headers.update({'Authorization': 'Bearer {:s}'.format(self.token)})
 
     def __get(self, url, params, headers):
-        return requests.get(url, params=params, headers=headers)
+        return self.session.get(url, params=params, headers=headers, timeout=self.timeout)
 
     def __post(self, url, params, headers):
         self.__set_content_type(headers, 'application/json')
-        return requests.post(url, data=json.dumps(params), headers=headers)
+        return self.session.post(url, data=json.dumps(params), headers=headers, timeout=self.timeout)
 
     def __put(self, url, params, headers):
         self.__set_content_type(headers, 'application/json')
-        return requests.put(url, params=params, headers=headers)
+        return self.session.put(url, params=params, headers=headers, timeout=self.timeout)
 
     def __delete(self, url, params, headers):
         self.__set_content_type(headers, 'application/x-www-form-urlencoded')
-        return requests.delete(url, params=params, headers=headers)
+        return self.session.delete(url, params=params, headers=headers, timeout=self.timeout)
 
     def __head(self, url, params, headers):
-        return requests.head(url, headers=headers)
+        return self.session.head(url, headers=headers, timeout=self.timeout)
 
     def __request(self, url, method, params, headers=None):
         headers = headers or {}
@@ -102,6 +130,76 @@ class BaseAPI(object):
 
         return request_method(url, params=params, headers=headers)
 
+    def __note_rate_limit(self, response):
+        # DO sends how many requests we have left and when the window resets with every response
+        remaining = response.headers.get('RateLimit-Remaining')
+        reset = response.headers.get('RateLimit-Reset')
+        retry_after = response.headers.get('Retry-After')
+        until = 0
+        if response.status_code == 429 and retry_after is not None:
+            until = time.time() + float(retry_after)
+        elif (response.status_code == 429 or (remaining is not None and int(remaining) <= 0)) and reset is not None:
+            until = float(reset)
+        elif response.status_code == 429:
+            until = time.time() + 60
+        if until:
+            with self.rate_limit_lock:
+                self.rate_limited_until = max(self.rate_limited_until, until)
+
+    def __wait_for_rate_limit(self):
+        delay = self.rate_limited_until - time.time()
+        if delay > 0:
+            print(f"Rate limited, waiting {delay:.0f}s")
+            time.sleep(delay)
+
+    def __send(self, url, method, params):
+        """Sends a request, retrying rate limits, server errors and dropped connections with exponential backoff."""
+        for attempt in range(self.retries + 1):
+            self.__wait_for_rate_limit()
+            retryable = attempt < self.retries
+            start = time.monotonic()
+            try:
+                response = self.__request(url, method, params)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.record_api_call(method, url, "error", time.monotonic() - start)
+                if not retryable or method not in self.IDEMPOTENT:
+                    raise
+            else:
+                metrics.record_api_call(method, url, response.status_code, time.monotonic() - start)
+                self.__note_rate_limit(response)
+                if response.status_code == 429 and retryable:
+                    continue
+                if response.status_code < 500 or not retryable or method not in self.IDEMPOTENT:
+                    return response
+            delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.0)
+            print(f"{method} {url} failed, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def __decode(self, response):
+        if response.status_code == 204:
+            return ''
+
+        try:
+            json = response.json()
+        except ValueError:
+            raise JSONDecodeError()
+
+        if not response.ok:
+            if response.status_code >= 500:
+                raise ResponseError(
+                    'Server did not respond. {:d} {:s}'.format(
+                        response.status_code, response.reason))
+
+            raise RequestError('{:d} {:s}. Message: {:s}'.format(
+                response.status_code, response.reason, json['message']))
+
+        return json
+
+    def __next_page(self, json):
+        if isinstance(json, dict):
+            return json.get("links", {}).get("pages", {}).get("next")
+        return None
+
     def request(self, url, method, params=None):
         params = params or {}
 
@@ -110,26 +208,68 @@ class BaseAPI(object):
 
         print(url, method, params)
 
-        response = self.__request(url, method, params)
+        json = self.__decode(self.__send(url, method, params))
+
+        # Listings that go past one page get the rest of their items merged in, so callers always see the whole thing.
+        # Use paginate() to get them lazily instead.
+        next_page = self.__next_page(json)
+        if next_page is not None:
+            keys = [key for key, value in json.items() if isinstance(value, list)]
+            if len(keys) != 1:
+                raise ResponseError(f"Can't tell which part of {url} is the paginated list")
+            while next_page is not None:
+                print(next_page, method)
+                page = self.__decode(self.__send(next_page, method, None))
+                json[keys[0]].extend(page.get(keys[0], []))
+                next_page = self.__next_page(page)
+            del json["links"]["pages"]
 
-        if response.status_code == 204:
-            json = ''
-        else:
-            try:
-                json = response.json()
-            except ValueError:
-                raise JSONDecodeError()
-
-            if not response.ok:
-                if response.status_code >= 500:
-                    raise ResponseError(
-                        'Server did not respond. {:d} {:s}'.format(
-                            response.status_code, response.reason))
-
-                raise RequestError('{:d} {:s}. Message: {:s}'.format(
-                    response.status_code, response.reason, json['message']))
-
-        if "links" in json and "pages" in json["links"] and "next" in json["links"]["pages"]:
-            raise ResponseError("Too many items in one page! Go ask Zorba to implement pagination.")
-        
         return json
+
+    def paginate(self, url, key, params=None):
+        """Yields every item in a listing, fetching pages as they're needed."""
+        params = dict(params or {})
+        params["per_page"] = 200
+        print(url, "GET", params)
+        page = self.__decode(self.__send(url, "GET", params))
+        while True:
+            yield from page.get(key, [])
+            next_page = self.__next_page(page)
+            if next_page is None:
+                return
+            print(next_page, "GET")
+            page = self.__decode(self.__send(next_page, "GET", None))
+
+    def wait_for_action(self, id, min_interval=1, max_interval=10):
+        """Polls an action until it's done. Starts out polling quickly, since plenty of actions finish in a second or two,
+        and backs off for the ones that don't. Blocks the calling thread; each volume and region already has its own."""
+        interval = min_interval
+        while True:
+            action = self.request(f"actions/{id}", "GET")["action"]
+            if action["status"] == "completed":
+                return action
+            elif action["status"] != "in-progress":
+                raise ActionFailed(f"Action {id} ({action.get('type')}) {action['status']}")
+            time.sleep(interval)
+            interval = min(interval * 1.5, max_interval)
+
+class AsyncAPI(object):
+    """asyncio front end to a BaseAPI, for issuing independent calls at the same time.
+
+    requests is blocking, so calls run on a thread pool; they still share the BaseAPI's session, connection pool and rate limiting."""
+    def __init__(self, api, concurrency=16):
+        self.api = api
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="api")
+
+    async def __call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def request(self, url, method, params=None):
+        return await self.__call(self.api.request, url, method, params)
+
+    async def paginate(self, url, key, params=None):
+        """Every item in a listing, as a list."""
+        return await self.__call(lambda: list(self.api.paginate(url, key, params)))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,195 @@
+import itertools
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# A fake DigitalOcean API: just the endpoints dosvob and api.BaseAPI use, with everything held in memory.
+#
+# Actions (droplet creation, attach, detach) stay in-progress for action_latency seconds. Listings paginate like the real thing and
+# responses carry RateLimit headers.
+
+class FakeDigitalOcean(object):
+    def __init__(self, volumes, action_latency=1.0, request_latency=0.0):
+        """volumes is a list of (name, region, size in gigabytes)."""
+        self.action_latency = action_latency
+        self.request_latency = request_latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.requests = 0
+
+        self.volumes = {}
+        for name, region, size in volumes:
+            volume_id = str(next(self.ids))
+            self.volumes[volume_id] = { 'id': volume_id, 'name': name, 'region': { 'slug': region }, 'size_gigabytes': size, 'tags': [],
+                'droplet_ids': [] }
+        self.snapshots = {}
+        self.droplets = {}
+        self.keys = {}
+        self.actions = {}
+
+    def _action(self, kind):
+        action_id = next(self.ids)
+        self.actions[action_id] = { 'id': action_id, 'type': kind, 'done_at': time.monotonic() + self.action_latency }
+        return action_id
+
+    def _action_json(self, action_id):
+        action = self.actions[action_id]
+        status = "completed" if time.monotonic() >= action['done_at'] else "in-progress"
+        return { 'id': action_id, 'type': action['type'], 'status': status }
+
+    def handle(self, method, path, query, body):
+        """Returns (status, json)."""
+        self.requests += 1
+        parts = [part for part in path.split('/') if part][1:]  # drop "v2"
+        with self.lock:
+            if parts == ['account', 'keys']:
+                if method == "GET":
+                    return 200, { 'ssh_keys': list(self.keys.values()) }
+                key_id = next(self.ids)
+                self.keys[key_id] = { 'id': key_id, 'name': body['name'] }
+                return 201, { 'ssh_key': self.keys[key_id] }
+            if parts[:2] == ['account', 'keys'] and method == "DELETE":
+                self.keys.pop(int(parts[2]), None)
+                return 204, None
+
+            if parts == ['droplets']:
+                if method == "GET":
+                    tag = query.get('tag_name')
+                    return 200, { 'droplets': [droplet for droplet in self.droplets.values() if tag is None or tag in droplet['tags']] }
+                droplet_id = next(self.ids)
+                self.droplets[droplet_id] = { 'id': droplet_id, 'name': body['name'], 'region': { 'slug': body['region'] }, 'tags': body.get('tags', []),
+                    'networks': { 'v4': [ { 'type': 'private', 'ip_address': '10.0.0.2' }, { 'type': 'public', 'ip_address': f"192.0.2.{droplet_id % 250}" } ] } }
+                return 202, { 'droplet': self.droplets[droplet_id], 'links': { 'actions': [ { 'id': self._action("create") } ] } }
+            if parts[0] == 'droplets':
+                droplet_id = int(parts[1])
+                if method == "DELETE":
+                    self.droplets.pop(droplet_id, None)
+                    return 204, None
+                if droplet_id not in self.droplets:
+                    return 404, { 'message': "droplet not found" }
+                return 200, { 'droplet': self.droplets[droplet_id] }
+
+            if parts == ['snapshots']:
+                return 200, { 'snapshots': list(self.snapshots.values()) }
+            if parts[0] == 'snapshots' and method == "DELETE":
+                self.snapshots.pop(parts[1], None)
+                return 204, None
+
+            if parts == ['volumes']:
+                if method == "GET":
+                    return 200, { 'volumes': list(self.volumes.values()) }
+                snapshot = self.snapshots[body['snapshot_id']]
+                original = self.volumes[snapshot['resource_id']]
+                volume_id = str(next(self.ids))
+                self.volumes[volume_id] = { 'id': volume_id, 'name': body['name'], 'region': original['region'],
+                    'size_gigabytes': body['size_gigabytes'], 'tags': body.get('tags', []), 'droplet_ids': [] }
+                return 201, { 'volume': self.volumes[volume_id] }
+            if parts[0] == 'volumes' and len(parts) == 2 and method == "DELETE":
+                if self.volumes.get(parts[1], {}).get('droplet_ids'):
+                    return 409, { 'message': "volume is attached" }
+                self.volumes.pop(parts[1], None)
+                return 204, None
+            if parts[0] == 'volumes' and parts[2:] == ['snapshots']:
+                volume = self.volumes[parts[1]]
+                snapshot_id = str(next(self.ids))
+                self.snapshots[snapshot_id] = { 'id': snapshot_id, 'name': body['name'], 'tags': body.get('tags', []), 'resource_id': parts[1],
+                    'min_disk_size': volume['size_gigabytes'] }
+                return 201, { 'snapshot': self.snapshots[snapshot_id] }
+            if parts[0] == 'volumes' and parts[2:] == ['actions']:
+                volume = self.volumes[parts[1]]
+                if body['type'] == 'attach':
+                    volume['droplet_ids'] = [body['droplet_id']]
+                else:
+                    volume['droplet_ids'] = []
+                return 202, { 'action': self._action_json(self._action(body['type'])) }
+
+            if parts[0] == 'actions':
+                return 200, { 'action': self._action_json(int(parts[1])) }
+
+        return 404, { 'message': f"fake api doesn't do {method} {path}" }
+
+def paginate(status, body, query, path):
+    """Cuts a listing down to the requested page and adds the links the real API sends."""
+    if status != 200 or body is None:
+        return body
+    lists = [key for key, value in body.items() if isinstance(value, list)]
+    if len(lists) != 1:
+        return body
+    per_page = int(query.get('per_page', 20))
+    page = int(query.get('page', 1))
+    items = body[lists[0]]
+    body = dict(body, **{ lists[0]: items[(page - 1) * per_page:page * per_page] })
+    body['links'] = { 'pages': {} }
+    if page * per_page < len(items):
+        body['links']['pages']['next'] = f"{path}?page={page + 1}&per_page={per_page}"
+    body['meta'] = { 'total': len(items) }
+    return body
+
+def serve(fake, port=0):
+    """Starts the fake API on a background thread. Returns the server; its endpoint is endpoint(server)."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, method):
+            if fake.request_latency:
+                time.sleep(fake.request_latency)
+            url = urlparse(self.path)
+            query = { key: values[0] for key, values in parse_qs(url.query).items() }
+            length = int(self.headers.get('content-length') or 0)
+            body = json.loads(self.rfile.read(length)) if length and method in ("POST", "PUT") else None
+            try:
+                status, response = fake.handle(method, url.path, query, body)
+            except KeyError as e:
+                status, response = 404, { 'message': f"not found: {e}" }
+            if method == "GET":
+                response = paginate(status, response, query, f"http://{self.headers['host']}{url.path}")
+            self.send_response(status)
+            self.send_header('RateLimit-Limit', '5000')
+            self.send_header('RateLimit-Remaining', '4999')
+            self.send_header('RateLimit-Reset', str(int(time.time()) + 3600))
+            if response is None:
+                self.end_headers()
+                return
+            data = json.dumps(response).encode()
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def do_DELETE(self):
+            self._respond("DELETE")
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fakeapi", daemon=True).start()
+    return server
+
+def endpoint(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v2/"
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a fake DigitalOcean API for benchmarking dosvob')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--volume', action='append', default=[], help='name:region:gigabytes; repeatable')
+    parser.add_argument('--action-latency', type=float, default=1.0, help='Seconds every action stays in progress')
+
+    args = parser.parse_args()
+
+    volumes = [(name, region, int(size)) for name, region, size in (spec.split(':') for spec in args.volume)]
+    server = serve(FakeDigitalOcean(volumes, args.action_latency), args.port)
+    print(f"Fake API at {endpoint(server)}")
+    threading.Event().wait()
+
+if __name__ == '__main__':
+    main()
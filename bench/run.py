@@ -0,0 +1,353 @@
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+import fakeapi
+import synth
+
+from glacier import apply_retention, do_glacier_pass, kept_snapshots
+from history import snapshot_name
+
+# Benchmarks. Each one builds everything it needs from scratch in a scratch directory, from seeded synthetic data, so two runs with the
+# same arguments do the same work:
+#
+#   glacier    do_glacier_pass throughput: a first pass over fresh volumes, an incremental pass after changing some of them, and a pass
+#              where nothing changed
+#   mount      ConcatFS.read latency, sequential and random, with ConcatFS's caches cold and warm
+#   retention  kept_snapshots over a long history, and apply_retention against a real history repo
+#   e2e        dosvob.py end to end, against the fake API in fakeapi.py and the ssh/scp/diskrsync stand-ins in stubs/
+#
+# Results print as they come and can be saved with --output; --compare shows how they moved against an earlier --output.
+
+default_policies = [
+    { 'name': "recent", 'last': 10 },
+    { 'name': "daily", 'frequency': "1 day", 'duration': "1 week" },
+    { 'name': "weekly", 'frequency': "1 week", 'duration': "1 month" },
+    { 'name': "monthly", 'frequency': "1 month", 'duration': "1 year" },
+]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def git_identity():
+    # the history repo's commits need someone to be from, and a scratch machine might not have a git identity set up
+    for variable in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        os.environ.setdefault(variable, "dosvob bench")
+    for variable in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        os.environ.setdefault(variable, "bench@localhost")
+
+def quiet(verbose):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+def uncache(path):
+    """Push a file out of the page cache, so the next pass reads it off the disk like it would after a real sync."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def make_volumes(directory, args):
+    names = []
+    for number in range(args.volumes):
+        name = f"vol{number}"
+        synth.generate(os.path.join(directory, name), args.size_mb * 1024 * 1024, args.zero_fraction, args.dup_fraction, seed=number)
+        names.append(name)
+    return names
+
+def glacier_options(args):
+    return { 'store': args.store, 'chunking': args.chunking, 'compression': args.compression, 'threads': args.threads }
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+def bench_glacier(args, work):
+    backups = os.path.join(work, "backups")
+    os.makedirs(os.path.join(backups, "glacier", "history"))
+    subprocess.run(['git', '-C', os.path.join(backups, "glacier", "history"), 'init', '-q'], check=True)
+    names = make_volumes(backups, args)
+    total_mb = args.volumes * args.size_mb
+
+    def glacier_pass():
+        for name in names:
+            uncache(os.path.join(backups, name))
+        start = time.monotonic()
+        with quiet(args.verbose):
+            do_glacier_pass(backups, [], **glacier_options(args))
+        return time.monotonic() - start
+
+    first = glacier_pass()
+    for number, name in enumerate(names):
+        synth.mutate(os.path.join(backups, name), args.change_rate, seed=1000 + number)
+    incremental = glacier_pass()
+    unchanged = glacier_pass()
+
+    return {
+        'first_pass_mb_per_s': total_mb / first,
+        'incremental_pass_mb_per_s': total_mb / incremental,
+        'incremental_pass_s': incremental,
+        'unchanged_pass_s': unchanged,
+        'store_mb': disk_usage(os.path.join(backups, "glacier")) / 1024 / 1024,
+    }
+
+def bench_mount(args, work):
+    try:
+        from mount import ConcatFS
+    except (ImportError, OSError) as e:
+        # fusepy wants libfuse at import time, even though nothing here mounts anything
+        print(f"mount: skipped, can't import mount.py ({e})")
+        return None
+
+    backups = os.path.join(work, "backups")
+    history_dir = os.path.join(backups, "glacier", "history")
+    os.makedirs(history_dir)
+    subprocess.run(['git', '-C', history_dir, 'init', '-q'], check=True)
+    size = args.size_mb * 1024 * 1024
+    synth.generate(os.path.join(backups, "vol0"), size, args.zero_fraction, args.dup_fraction, seed=0)
+    with quiet(args.verbose):
+        do_glacier_pass(backups, [], **glacier_options(args))
+
+    rng = random.Random(0)
+    random_offsets = [rng.randrange(0, size - 4096) for _ in range(args.reads)]
+
+    def timed_reads(filesystem, reads):
+        latencies = []
+        for offset, length in reads:
+            start = time.perf_counter()
+            filesystem.read("/vol0", length, offset, None)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results = {}
+    sequential = [(offset, 128 * 1024) for offset in range(0, size, 128 * 1024)]
+    for cache in ("cold", "warm"):
+        filesystem = ConcatFS(history_dir, readahead=args.readahead)
+        try:
+            if cache == "warm":
+                timed_reads(filesystem, sequential)
+            start = time.monotonic()
+            latencies = timed_reads(filesystem, sequential)
+            results[f'sequential_{cache}_mb_per_s'] = size / 1024 / 1024 / (time.monotonic() - start)
+            results[f'sequential_{cache}_p99_us'] = percentile(latencies, 0.99) * 1e6
+        finally:
+            filesystem.destroy("/")
+
+        filesystem = ConcatFS(history_dir, readahead=args.readahead)
+        try:
+            reads = [(offset, 4096) for offset in random_offsets]
+            if cache == "warm":
+                timed_reads(filesystem, reads)
+            latencies = timed_reads(filesystem, reads)
+            results[f'random_{cache}_p50_us'] = percentile(latencies, 0.5) * 1e6
+            results[f'random_{cache}_p99_us'] = percentile(latencies, 0.99) * 1e6
+        finally:
+            filesystem.destroy("/")
+    return results
+
+def bench_retention(args, work):
+    policies = default_policies
+    if args.policies:
+        with open(args.policies) as f:
+            policies = json.load(f)
+
+    # an hourly-ish backup going back args.snapshots hours, with some jitter and the odd missed run
+    rng = random.Random(0)
+    newest = datetime(2024, 1, 1)
+    snapshots = []
+    moment = newest
+    for number in range(args.snapshots):
+        snapshots.append((moment, f"{number:040x}"))
+        moment -= timedelta(hours=rng.choice((1, 1, 1, 2)), minutes=rng.randrange(-5, 6))
+    now = newest + timedelta(minutes=30)
+
+    runs = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        kept = kept_snapshots(snapshots, policies, now)
+        runs.append(time.perf_counter() - start)
+    results = { 'kept_snapshots_s': min(runs), 'kept': len(kept) }
+
+    # a real history repo, with one snapshot ref per run, written in one go with fast-import
+    history_dir = os.path.join(work, "history")
+    subprocess.run(['git', 'init', '-q', history_dir], check=True)
+    commits = []
+    for moment, commit in reversed(snapshots[:args.git_snapshots]):
+        timestamp = int(moment.timestamp())
+        commits.append(f"commit refs/snapshots/{snapshot_name(timestamp)}\ncommitter bench <bench@localhost> {timestamp} +0000\ndata 0\n\n")
+    subprocess.run(['git', '-C', history_dir, 'fast-import', '--quiet'], input="".join(commits), text=True, check=True)
+
+    with quiet(args.verbose):
+        start = time.perf_counter()
+        apply_retention(history_dir, policies, dry_run=True, now=now)
+        results['apply_retention_dry_run_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        results['deleted'] = apply_retention(history_dir, policies, now=now)
+        results['apply_retention_s'] = time.perf_counter() - start
+    return results
+
+def bench_e2e(args, work):
+    volumes_dir = os.path.join(work, "volumes")
+    run_dir = os.path.join(work, "run")
+    home_dir = os.path.join(work, "home")
+    os.makedirs(volumes_dir)
+    os.makedirs(run_dir)
+    os.makedirs(os.path.join(home_dir, ".ssh"))
+    with open(os.path.join(home_dir, ".ssh", "id_rsa.pub"), 'w') as f:
+        f.write("ssh-ed25519 AAAA bench@localhost\n")
+    names = make_volumes(volumes_dir, args)
+
+    regions = args.regions.split(',')
+    fake = fakeapi.FakeDigitalOcean([(name, regions[number % len(regions)], max(1, args.size_mb // 1024)) for number, name in enumerate(names)],
+        action_latency=args.action_latency, request_latency=args.request_latency)
+    server = fakeapi.serve(fake)
+
+    conf = {
+        'do_token': "bench",
+        'api_endpoint': fakeapi.endpoint(server),
+        'snapshot_retention': default_policies,
+        'volumes_in_flight': args.volumes_in_flight,
+        'parallel_transfers': args.parallel_transfers,
+        'glacier_after_sync': args.glacier_after_sync,
+        'glacier': dict(glacier_options(args), apply_retention=True),
+        'healthchecks': "",
+    }
+    with open(os.path.join(run_dir, "conf.json"), 'w') as f:
+        json.dump(conf, f)
+
+    environment = dict(os.environ, HOME=home_dir, PATH=f"{os.path.join(bench_dir, 'stubs')}{os.pathsep}{os.environ['PATH']}",
+        BENCH_VOLUMES=volumes_dir, BENCH_TRANSFER_MBPS=str(args.transfer_mbps or ""), BENCH_SSH_LATENCY=str(args.ssh_latency))
+
+    def run(label):
+        requests_before = fake.requests
+        start = time.monotonic()
+        with open(os.path.join(work, f"{label}.log"), 'w') as log:
+            result = subprocess.run([sys.executable, os.path.join(repo_dir, "dosvob.py")], cwd=run_dir, env=environment, stdout=log,
+                stderr=subprocess.STDOUT)
+        elapsed = time.monotonic() - start
+        if result.returncode != 0:
+            with open(os.path.join(work, f"{label}.log")) as log:
+                print(log.read()[-4000:])
+            raise RuntimeError(f"dosvob.py failed on the {label} run")
+        return elapsed, fake.requests - requests_before
+
+    try:
+        first, first_requests = run("first")
+        for number, name in enumerate(names):
+            synth.mutate(os.path.join(volumes_dir, name), args.change_rate, seed=1000 + number)
+        second, second_requests = run("second")
+    finally:
+        server.shutdown()
+
+    # dosvob's own report on the second run says where the time went
+    with open(os.path.join(run_dir, "backups", "glacier", "report.json")) as f:
+        report = json.load(f)
+    return { 'first_run_s': first, 'second_run_s': second, 'api_requests_per_run': second_requests, 'api_seconds': report['api']['seconds'],
+        'written_mb': report['totals'].get('bytes_written', 0) / 1024 / 1024 }
+
+benchmarks = {
+    'glacier': bench_glacier,
+    'mount': bench_mount,
+    'retention': bench_retention,
+    'e2e': bench_e2e,
+}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark dosvob against synthetic volumes and a fake DigitalOcean API')
+    parser.add_argument('benchmarks', nargs='*', default=list(benchmarks), help=f"Which to run, out of {', '.join(benchmarks)}; defaults to all")
+    parser.add_argument('--output', type=str, default=None, help='Save the results as JSON')
+    parser.add_argument('--compare', type=str, default=None, help='Show the change against results saved earlier with --output')
+    parser.add_argument('--keep', action='store_true', help='Leave the scratch directory behind to look at')
+    parser.add_argument('--verbose', action='store_true', help='Show what the glacier pass and retention print')
+
+    volumes = parser.add_argument_group('synthetic volumes')
+    volumes.add_argument('--volumes', type=int, default=2)
+    volumes.add_argument('--size-mb', type=int, default=256)
+    volumes.add_argument('--zero-fraction', type=float, default=0.3)
+    volumes.add_argument('--dup-fraction', type=float, default=0.1)
+    volumes.add_argument('--change-rate', type=float, default=0.05, help='Fraction of blocks changed between runs')
+
+    glacier = parser.add_argument_group('glacier')
+    glacier.add_argument('--store', type=str, default="loose")
+    glacier.add_argument('--chunking', type=str, default="fixed")
+    glacier.add_argument('--compression', type=str, default="none")
+    glacier.add_argument('--threads', type=int, default=None)
+
+    mount = parser.add_argument_group('mount')
+    mount.add_argument('--reads', type=int, default=2000, help='Random 4kb reads to time')
+    mount.add_argument('--readahead', type=int, default=4)
+
+    retention = parser.add_argument_group('retention')
+    retention.add_argument('--snapshots', type=int, default=100000, help='Snapshots in the in-memory history')
+    retention.add_argument('--git-snapshots', type=int, default=2000, help='Snapshots in the history repo')
+    retention.add_argument('--policies', type=str, default=None, help='JSON file of retention policies; defaults to conf.json.example\'s')
+    retention.add_argument('--repeat', type=int, default=5)
+
+    e2e = parser.add_argument_group('e2e')
+    e2e.add_argument('--regions', type=str, default="nyc1", help='Comma-separated regions to spread the volumes over')
+    e2e.add_argument('--action-latency', type=float, default=2.0, help='Seconds each fake action takes')
+    e2e.add_argument('--request-latency', type=float, default=0.0, help='Seconds each fake API request takes')
+    e2e.add_argument('--ssh-latency', type=float, default=0.0, help='Seconds each stub ssh or scp takes')
+    e2e.add_argument('--transfer-mbps', type=float, default=None, help='Cap on the stub diskrsync\'s "download" rate')
+    e2e.add_argument('--volumes-in-flight', type=int, default=2)
+    e2e.add_argument('--parallel-transfers', type=int, default=1)
+    e2e.add_argument('--glacier-after-sync', action='store_true')
+
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in benchmarks]
+    if unknown:
+        parser.error(f"No benchmark called {', '.join(unknown)}")
+
+    git_identity()
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for name in args.benchmarks:
+        work = tempfile.mkdtemp(prefix=f"dosvob-bench-{name}-")
+        try:
+            print(f"{name}:")
+            result = benchmarks[name](args, work)
+        finally:
+            if args.keep:
+                print(f"  scratch directory left at {work}")
+            else:
+                shutil.rmtree(work, ignore_errors=True)
+        if result is None:
+            continue
+        results[name] = result
+        for metric, value in result.items():
+            line = f"  {metric:<32} {value:12.3f}" if isinstance(value, float) else f"  {metric:<32} {value:12}"
+            previous = baseline.get(name, {}).get(metric)
+            if previous:
+                line += f"  ({(value - previous) / previous * 100:+.1f}%)"
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'arguments': vars(args), 'results': results }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import random
+
+# Synthetic volumes for benchmarking: random data, with some fraction of the blocks left as zeros (empty space) and some fraction copies
+# of earlier blocks (the same file twice, a filesystem's backup superblocks), so dedup and zero handling have something to do.
+# Everything comes from a seeded PRNG, so the same arguments always give the same bytes.
+
+block_size = 1024*1024
+
+def random_bytes(rng, count):
+    return rng.getrandbits(count * 8).to_bytes(count, 'little')
+
+def generate(path, size, zero_fraction=0.3, dup_fraction=0.1, seed=0):
+    """Write a size-byte volume to path. Zero blocks are left as holes."""
+    rng = random.Random(seed)
+    blocks = []  # offsets of the non-zero blocks written so far, for duplicates to copy
+    with open(path, 'w+b') as f:
+        f.truncate(size)
+        for offset in range(0, size, block_size):
+            length = min(block_size, size - offset)
+            roll = rng.random()
+            if roll < zero_fraction:
+                continue
+            if roll < zero_fraction + dup_fraction and blocks:
+                f.seek(rng.choice(blocks))
+                block = f.read(length)
+                block += bytes(length - len(block))
+            else:
+                block = random_bytes(rng, length)
+            f.seek(offset)
+            f.write(block)
+            if length == block_size:
+                blocks.append(offset)
+
+def mutate(path, change_rate, seed=1, write_size=64*1024, zero_fraction=0.1):
+    """Scribble over change_rate of the volume's blocks, the way a night of use might: each changed block gets one write_size-byte write
+    at a random spot in it, and some of those writes are zeros (deleted files). Returns the number of blocks changed."""
+    rng = random.Random(seed)
+    size = os.path.getsize(path)
+    block_count = (size + block_size - 1) // block_size
+    changed = rng.sample(range(block_count), round(block_count * change_rate))
+    with open(path, 'r+b') as f:
+        for block in sorted(changed):
+            start = block * block_size
+            length = min(block_size, size - start)
+            count = min(write_size, length)
+            offset = start + rng.randrange(0, length - count + 1, 4096) if length > count else start
+            f.seek(offset)
+            f.write(bytes(count) if rng.random() < zero_fraction else random_bytes(rng, count))
+    return len(changed)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Make or change a synthetic volume for benchmarking')
+    parser.add_argument('path', type=str, help='Volume file to write')
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of a new volume')
+    parser.add_argument('--zero-fraction', type=float, default=0.3, help='Fraction of blocks that are empty')
+    parser.add_argument('--dup-fraction', type=float, default=0.1, help='Fraction of blocks that copy an earlier block')
+    parser.add_argument('--change-rate', type=float, default=None, help='Change this fraction of an existing volume\'s blocks instead')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.change_rate is not None:
+        print(f"Changed {mutate(args.path, args.change_rate, args.seed)} blocks")
+    else:
+        generate(args.path, args.size_mb * 1024 * 1024, args.zero_fraction, args.dup_fraction, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,576 @@
+import hashlib
+import lzma
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Where chunks actually live on disk.
+#
+# There are two layouts:
+#  * loose: every chunk is its own file at glacier/chunks/xx/<sha256>. Simple, but a big volume turns into hundreds of thousands of tiny files.
+#  * pack: chunks are appended to large glacier/packs/pack-NNNNNN.pack files, with glacier/packs/index mapping hash -> (pack, offset, length).
+#
+# Both expose the same interface: has(hash), put(hash, data), prepare(hash, data), put_stored(hash, codec, payload), get(hash), locate(hash),
+# hashes(), sync(), close().
+# A pack store also reads through to any loose chunks that haven't been migrated yet, so switching layouts doesn't lose anything.
+#
+# Neither one touches the filesystem to answer has(): the pack index lives in memory, and the loose store keeps a presence index at
+# glacier/chunks/index (a sorted array of raw digests) that gets loaded once per pass and rewritten on close.
+#
+# Chunks can optionally be compressed. The codec is recorded per chunk (in the pack index, or as a filename suffix for loose chunks),
+# so a store can hold a mix, and a chunk that doesn't shrink is just stored raw.
+
+codecs = { "none": 0, "zlib": 1, "lzma": 2, "zstd": 3 }
+codec_names = { number: name for name, number in codecs.items() }
+
+def encode_chunk(codec, data, level=None):
+    if codec == "none":
+        return data
+    elif codec == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    elif codec == "lzma":
+        return lzma.compress(data, preset=0 if level is None else level)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError(f"Unsupported compression: {codec}")
+
+def decode_chunk(codec, payload):
+    if codec == "none":
+        return payload
+    elif codec == "zlib":
+        return zlib.decompress(payload)
+    elif codec == "lzma":
+        return lzma.decompress(payload)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This chunk is zstd-compressed, which needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unsupported compression: {codec}")
+
+def compress_chunk(codec, data, level=None):
+    """Returns (codec, payload), falling back to storing it raw if compression doesn't help."""
+    if codec == "none":
+        return codec, data
+    payload = encode_chunk(codec, data, level)
+    if len(payload) >= len(data):
+        return "none", data
+    return codec, payload
+
+class LooseStore(object):
+    def __init__(self, glacier_dir, fallback=None, readonly=False, compression="none", compression_level=None):
+        self.chunks_dir = os.path.join(glacier_dir, "chunks")
+        self.index_path = os.path.join(self.chunks_dir, "index")
+        self.fallback = fallback
+        self.readonly = readonly
+        self.compression = compression
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+
+        # Presence index: the set of raw digests we know are on disk, so dedup checks never have to stat anything.
+        # Loaded the first time someone asks, written back in one go on close.
+        self.present = None
+        self.dirty = False
+        self.made_dirs = set()
+
+    def path(self, hash, codec="none"):
+        # raw chunks are just named after their hash; compressed ones get the codec tacked on
+        name = hash if codec == "none" else f"{hash}.{codec}"
+        return os.path.join(self.chunks_dir, hash[:2], name)
+
+    def _present(self):
+        with self.lock:
+            if self.present is None:
+                self.present = self._load_index()
+            return self.present
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # lost or never built, so build it from what's actually on disk
+            if os.path.isdir(self.chunks_dir):
+                print(f"No chunk index in {self.chunks_dir}, rebuilding it")
+            self.dirty = True
+            return set(bytes.fromhex(hash) for hash in self.scan())
+        return set(data[i:i + 32] for i in range(0, len(data) - len(data) % 32, 32))
+
+    def has(self, hash):
+        if bytes.fromhex(hash) in self._present():
+            return True
+        return self.fallback is not None and self.fallback.has(hash)
+
+    def put(self, hash, data):
+        # if it already exists, we're good
+        if self.has(hash):
+            return
+        self.put_stored(hash, *compress_chunk(self.compression, data, self.compression_level))
+
+    def prepare(self, hash, data):
+        """Returns the (codec, payload) put_stored needs for this chunk, or None if we already have it. Safe to call from any thread."""
+        if self.has(hash):
+            return None
+        return compress_chunk(self.compression, data, self.compression_level)
+
+    def put_stored(self, hash, codec, payload):
+        """Store an already-encoded chunk. Returns False if it was already there."""
+        if self.has(hash):
+            return False
+        chunk_path = self.path(hash, codec)
+        chunk_dir = os.path.dirname(chunk_path)
+        if chunk_dir not in self.made_dirs:
+            os.makedirs(chunk_dir, exist_ok=True)
+            self.made_dirs.add(chunk_dir)
+
+        # write to a temp file and rename it into place, so a crash halfway through can't leave a truncated chunk that looks valid
+        temp_path = f"{chunk_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as chunk_file:
+            chunk_file.write(payload)
+        os.replace(temp_path, chunk_path)
+
+        # only marked present once it's really there
+        self._present().add(bytes.fromhex(hash))
+        self.dirty = True
+        return True
+
+    def read_stored(self, hash):
+        """Returns (codec, payload) exactly as stored."""
+        location = self.locate(hash)
+        if location is None:
+            raise FileNotFoundError(hash)
+        path, offset, length, codec = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return codec, f.read(length)
+
+    def get(self, hash):
+        return decode_chunk(*self.read_stored(hash))
+
+    def locate(self, hash):
+        """Returns (path, offset, stored length, codec) of the chunk's bytes, or None if we don't have it."""
+        for codec in codecs:
+            chunk_path = self.path(hash, codec)
+            try:
+                return chunk_path, 0, os.path.getsize(chunk_path), codec
+            except FileNotFoundError:
+                pass
+        return self.fallback.locate(hash) if self.fallback is not None else None
+
+    def scan(self):
+        """Every loose chunk hash actually on disk. This walks the whole chunk directory, so it's slow."""
+        if not os.path.isdir(self.chunks_dir):
+            return
+        for prefix in sorted(os.listdir(self.chunks_dir)):
+            prefix_dir = os.path.join(self.chunks_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in sorted(os.listdir(prefix_dir)):
+                hash, _, codec = name.partition(".")
+                if len(hash) == 64 and (codec == "" or codec in codecs):
+                    yield hash
+
+    def hashes(self):
+        """Every chunk hash in the store."""
+        if self.fallback is not None:
+            yield from self.fallback.hashes()
+        for digest in sorted(self._present()):
+            yield digest.hex()
+
+    def remove(self, hash):
+        location = self.locate(hash)
+        if location is None or not location[0].startswith(self.chunks_dir):
+            raise FileNotFoundError(hash)
+        os.remove(location[0])
+        self._present().discard(bytes.fromhex(hash))
+        self.dirty = True
+
+    def sync(self):
+        # a loose chunk is in place as soon as put_stored renames it there, and a presence index that's behind just means a chunk
+        # gets written again, so there's nothing to do before a manifest can point at what's been stored
+        pass
+
+    def write_index(self):
+        """Write the presence index out as a sorted array of raw digests."""
+        if not os.path.isdir(self.chunks_dir):
+            return
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(b"".join(sorted(self._present())))
+        os.replace(temp_path, self.index_path)
+        self.dirty = False
+
+    def close(self):
+        if self.dirty and not self.readonly:
+            self.write_index()
+        if self.fallback is not None:
+            self.fallback.close()
+
+# Packs and the pack index both start with a magic and a version. Version 1 had neither, so anything without a magic is version 1.
+pack_magic = b"DVPK"
+pack_index_magic = b"DVPI"
+format_header = struct.Struct("<4sI")
+pack_version = 2
+
+# Each chunk in a pack is preceded by its raw digest, stored length, and codec, so the index can be rebuilt from the packs alone if it's ever lost.
+pack_entry_headers = { 1: struct.Struct("<32sI"), 2: struct.Struct("<32sIB") }
+
+# Index records: raw digest, pack number, offset of the data within the pack, stored length, codec.
+index_records = { 1: struct.Struct("<32sIQI"), 2: struct.Struct("<32sIQIB") }
+
+def read_format_version(f, magic):
+    """Reads the header off a pack or index, returning (version, header size). Leaves f positioned after the header."""
+    header = f.read(format_header.size)
+    if len(header) == format_header.size:
+        found_magic, version = format_header.unpack(header)
+        if found_magic == magic:
+            return version, format_header.size
+    f.seek(0)
+    return 1, 0
+
+class PackStore(object):
+    def __init__(self, glacier_dir, pack_size=1024*1024*1024, readonly=False, fallback=None, compression="none", compression_level=None):
+        self.packs_dir = os.path.join(glacier_dir, "packs")
+        self.index_path = os.path.join(self.packs_dir, "index")
+        self.pack_size = pack_size
+        self.readonly = readonly
+        self.fallback = fallback
+        self.compression = compression
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+
+        # digest -> (pack, offset, stored length, codec)
+        self.entries = {}
+
+        # current pack we're appending to, plus index records that aren't durable yet
+        self.pack_number = None
+        self.pack_file = None
+        self.pack_offset = 0
+        self.pending_records = []
+
+        if not readonly:
+            os.makedirs(self.packs_dir, exist_ok=True)
+        self._load_index()
+
+    def pack_path(self, number):
+        return os.path.join(self.packs_dir, f"pack-{number:06d}.pack")
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            version, header_size = read_format_version(f, pack_index_magic)
+            data = f.read()
+        record = index_records[version]
+        # a torn trailing record from a crash gets ignored, and then dropped when we next write the index
+        usable = len(data) - len(data) % record.size
+        for fields in record.iter_unpack(data[:usable]):
+            digest, pack, offset, length = fields[:4]
+            codec = codec_names[fields[4]] if version >= 2 else "none"
+            self.entries[digest] = (pack, offset, length, codec)
+        if not self.readonly and (version != pack_version or usable != len(data)):
+            # upgrade (or trim) the index in one go, so from here on we can just append
+            self._write_index()
+
+    def _write_index(self):
+        record = index_records[pack_version]
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(format_header.pack(pack_index_magic, pack_version))
+            f.write(b"".join(record.pack(digest, pack, offset, length, codecs[codec]) for digest, (pack, offset, length, codec) in self.entries.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.index_path)
+
+    def _new_pack(self, number):
+        self.pack_number = number
+        self.pack_file = open(self.pack_path(number), 'wb')
+        self.pack_file.write(format_header.pack(pack_magic, pack_version))
+        self.pack_offset = format_header.size
+
+    def _recover(self, number, start):
+        """Index the chunks after start in a pack that were written before a crash but never made it into the index; a manifest
+        may already point at them. Stops at the first entry that's torn or doesn't check out. Returns where the last good one ends."""
+        recovered = 0
+        with open(self.pack_path(number), 'rb') as f:
+            version, header_size = read_format_version(f, pack_magic)
+            entry_header = pack_entry_headers[version]
+            end = max(start, header_size)
+            f.seek(end)
+            while True:
+                header = f.read(entry_header.size)
+                if len(header) < entry_header.size:
+                    break
+                fields = entry_header.unpack(header)
+                digest, length = fields[:2]
+                codec = codec_names.get(fields[2]) if version >= 2 else "none"
+                payload = f.read(length)
+                if codec is None or length == 0 or len(payload) < length:
+                    break
+                try:
+                    if hashlib.sha256(decode_chunk(codec, payload)).digest() != digest:
+                        break
+                except Exception:
+                    break
+                offset = end + entry_header.size
+                if digest not in self.entries:
+                    self.entries[digest] = (number, offset, length, codec)
+                    self.pending_records.append(index_records[pack_version].pack(digest, number, offset, length, codecs[codec]))
+                    recovered += 1
+                end = offset + length
+            if recovered:
+                # it was only ever written, never synced
+                os.fsync(f.fileno())
+        if recovered:
+            print(f"Recovered {recovered} unindexed chunks from {self.pack_path(number)}")
+        return end
+
+    def _open_pack(self):
+        """Open a pack for appending, reusing the last one if it has room left."""
+        numbers = [entry[0] for entry in self.entries.values()]
+        last = max(numbers) if numbers else 0
+        # a crash can leave chunks after the last indexed one, in the last indexed pack or in packs started after it
+        on_disk = [int(name[len("pack-"):-len(".pack")]) for name in os.listdir(self.packs_dir) if name.startswith("pack-") and name.endswith(".pack")]
+        newest = max(on_disk + [last])
+        end = 0
+        for number in range(max(last, 1), newest + 1):
+            if os.path.exists(self.pack_path(number)):
+                start = max((offset + length for pack, offset, length, codec in self.entries.values() if pack == number), default=0)
+                end = self._recover(number, start)
+        if newest and os.path.exists(self.pack_path(newest)) and end < self.pack_size:
+            pack_file = open(self.pack_path(newest), 'r+b')
+            version, header_size = read_format_version(pack_file, pack_magic)
+            if version == pack_version:
+                self.pack_number = newest
+                self.pack_file = pack_file
+                # whatever's left past the last good chunk is a torn write; chop it off
+                self.pack_file.truncate(end)
+                self.pack_file.seek(end)
+                self.pack_offset = end
+                self._sync()
+                return
+            # old-format pack, leave it alone
+            pack_file.close()
+        self._new_pack(newest + 1)
+        self._sync()
+
+    def _sync(self):
+        """Make everything written so far durable: pack data first, then the index records that point at it."""
+        if self.pack_file is not None:
+            self.pack_file.flush()
+            os.fsync(self.pack_file.fileno())
+        if self.pending_records:
+            if not os.path.exists(self.index_path):
+                with open(self.index_path, 'wb') as f:
+                    f.write(format_header.pack(pack_index_magic, pack_version))
+            with open(self.index_path, 'ab') as f:
+                f.write(b"".join(self.pending_records))
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending_records = []
+
+    def sync(self):
+        """Make every chunk stored so far durable and indexed, so a manifest can safely point at them."""
+        with self.lock:
+            self._sync()
+
+    def has(self, hash):
+        if bytes.fromhex(hash) in self.entries:
+            return True
+        return self.fallback is not None and self.fallback.has(hash)
+
+    def put(self, hash, data):
+        if bytes.fromhex(hash) in self.entries:
+            return
+        if self.fallback is not None and self.fallback.has(hash):
+            # still sitting in the loose store; migrate will pick it up
+            return
+        # compress outside the lock so other threads can keep appending
+        self.put_stored(hash, *compress_chunk(self.compression, data, self.compression_level))
+
+    def prepare(self, hash, data):
+        """Returns the (codec, payload) put_stored needs for this chunk, or None if we already have it. Safe to call from any thread."""
+        if self.has(hash):
+            return None
+        return compress_chunk(self.compression, data, self.compression_level)
+
+    def put_stored(self, hash, codec, payload):
+        """Store an already-encoded chunk. Returns False if it was already there."""
+        if self.readonly:
+            raise RuntimeError("Can't store chunks in a read-only pack store")
+        digest = bytes.fromhex(hash)
+        with self.lock:
+            if digest in self.entries:
+                return False
+            if self.pack_file is None:
+                self._open_pack()
+            elif self.pack_offset >= self.pack_size:
+                # pack boundary: this is the only place we pay for an fsync mid-pass
+                self._sync()
+                self.pack_file.close()
+                self._new_pack(self.pack_number + 1)
+
+            entry_header = pack_entry_headers[pack_version]
+            self.pack_file.write(entry_header.pack(digest, len(payload), codecs[codec]))
+            self.pack_file.write(payload)
+            offset = self.pack_offset + entry_header.size
+            self.pack_offset = offset + len(payload)
+            self.entries[digest] = (self.pack_number, offset, len(payload), codec)
+            self.pending_records.append(index_records[pack_version].pack(digest, self.pack_number, offset, len(payload), codecs[codec]))
+        return True
+
+    def locate(self, hash):
+        """Returns (path, offset, stored length, codec) of the chunk's bytes, or None if we don't have it."""
+        entry = self.entries.get(bytes.fromhex(hash))
+        if entry is None:
+            return self.fallback.locate(hash) if self.fallback is not None else None
+        pack, offset, length, codec = entry
+        return self.pack_path(pack), offset, length, codec
+
+    def read_stored(self, hash):
+        """Returns (codec, payload) exactly as stored."""
+        location = self.locate(hash)
+        if location is None:
+            raise FileNotFoundError(hash)
+        path, offset, length, codec = location
+        # flush first in case we're reading back something that's still sitting in our write buffer
+        with self.lock:
+            if self.pack_file is not None:
+                self.pack_file.flush()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return codec, f.read(length)
+
+    def get(self, hash):
+        return decode_chunk(*self.read_stored(hash))
+
+    def hashes(self):
+        for digest in self.entries:
+            yield digest.hex()
+        if self.fallback is not None:
+            yield from self.fallback.hashes()
+
+    def close(self):
+        with self.lock:
+            if not self.readonly:
+                self._sync()
+                if self.pack_file is not None:
+                    self.pack_file.close()
+                    self.pack_file = None
+        if self.fallback is not None:
+            self.fallback.close()
+
+def open_store(glacier_dir, store=None, readonly=False, **options):
+    """Open the chunk store in glacier_dir.
+
+    store picks the layout new chunks get written in, defaulting to packs if there are any; either way, chunks in both layouts are readable."""
+    has_packs = os.path.isdir(os.path.join(glacier_dir, "packs"))
+    if store is None:
+        store = "pack" if has_packs else "loose"
+
+    compression = options.pop("compression", "none")
+    compression_level = options.pop("compression_level", None)
+    if store == "loose":
+        fallback = PackStore(glacier_dir, readonly=True) if has_packs else None
+        return LooseStore(glacier_dir, fallback=fallback, readonly=readonly, compression=compression, compression_level=compression_level)
+    elif store == "pack":
+        fallback = LooseStore(glacier_dir, readonly=readonly)
+        return PackStore(glacier_dir, readonly=readonly, fallback=fallback, compression=compression, compression_level=compression_level, **options)
+    else:
+        raise ValueError(f"Unsupported chunk store: {store}")
+
+def chunk_length(store, hash):
+    """How long a chunk is once decoded. Only needed for old text manifests, which don't record lengths."""
+    location = store.locate(hash)
+    if location is None:
+        raise FileNotFoundError(f"Chunk {hash} is missing from the store")
+    path, offset, stored_length, codec = location
+    if codec != "none":
+        return len(store.get(hash))
+    return stored_length
+
+def rebuild_pack_index(glacier_dir):
+    """Regenerate packs/index by scanning every pack."""
+    packs_dir = os.path.join(glacier_dir, "packs")
+    store = PackStore(glacier_dir, readonly=True)
+    store.entries = {}
+    for name in sorted(os.listdir(packs_dir)):
+        if not (name.startswith("pack-") and name.endswith(".pack")):
+            continue
+        number = int(name[len("pack-"):-len(".pack")])
+        with open(os.path.join(packs_dir, name), 'rb') as f:
+            version, offset = read_format_version(f, pack_magic)
+            entry_header = pack_entry_headers[version]
+            while True:
+                header = f.read(entry_header.size)
+                if len(header) < entry_header.size:
+                    break
+                fields = entry_header.unpack(header)
+                digest, length = fields[:2]
+                codec = codec_names[fields[2]] if version >= 2 else "none"
+                offset += entry_header.size
+                if len(f.read(length)) < length:
+                    # torn write at the end of the pack
+                    break
+                store.entries[digest] = (number, offset, length, codec)
+                offset += length
+
+    store._write_index()
+    print(f"Rebuilt pack index with {len(store.entries)} chunks")
+
+def migrate_to_packs(glacier_dir, pack_size=1024*1024*1024):
+    """Move every loose chunk into packs, deleting the loose copy once the pack holding it is durable."""
+    loose = LooseStore(glacier_dir)
+    packs = PackStore(glacier_dir, pack_size=pack_size)
+    migrated = []
+    try:
+        for hash in list(loose.scan()):
+            # already-compressed chunks move over as they are
+            packs.put_stored(hash, *loose.read_stored(hash))
+            migrated.append(hash)
+            # periodically sync and clean up so we don't need twice the disk space for the whole store
+            if len(migrated) >= 1024:
+                with packs.lock:
+                    packs._sync()
+                for done in migrated:
+                    loose.remove(done)
+                migrated = []
+    finally:
+        packs.close()
+    for done in migrated:
+        loose.remove(done)
+    loose.close()
+    print(f"Migrated loose chunks into {packs.packs_dir}")
+
+def rebuild_loose_index(glacier_dir):
+    """Regenerate chunks/index by walking the loose chunk directory."""
+    loose = LooseStore(glacier_dir)
+    loose.present = set(bytes.fromhex(hash) for hash in loose.scan())
+    loose.write_index()
+    print(f"Rebuilt loose chunk index with {len(loose.present)} chunks")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Maintenance tools for the glacier chunk store')
+    parser.add_argument('command', choices=['migrate', 'rebuild-index'], help='migrate: move loose chunks into packs; rebuild-index: regenerate the chunk indexes from what is actually on disk')
+    parser.add_argument('glacier_dir', type=str, help='Glacier directory, usually backups/glacier')
+    parser.add_argument('--pack-size', type=int, default=1024*1024*1024, help='Size at which a pack gets closed and a new one started')
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate_to_packs(args.glacier_dir, args.pack_size)
+    elif args.command == 'rebuild-index':
+        rebuild_loose_index(args.glacier_dir)
+        if os.path.isdir(os.path.join(args.glacier_dir, "packs")):
+            rebuild_pack_index(args.glacier_dir)
+
+if __name__ == '__main__':
+    main()
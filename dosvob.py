@@ -1,19 +1,22 @@
 import api
+import asyncio
 import datetime
 import json
 import os
 import pathlib
 import requests
+import threading
 import time
 
-from glacier import do_glacier_pass
-from util import execute
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from glacier import GlacierPass
+from metrics import metrics
+from util import execute, phase, print_timings
     
 dosvob_ephemeral_tag = "dosvob-ephemeral"
 has_dosvob_ephemeral_tag = lambda item: dosvob_ephemeral_tag in item["tags"]
 conf = json.loads(pathlib.Path("conf.json").read_text())
 token = conf["do_token"]
-region = conf["region"]
 
 dosvob_key_name = f"{dosvob_ephemeral_tag}-key"
 
@@ -22,46 +25,48 @@ if conf["healthchecks"] != "":
     requests.get(f"{conf['healthchecks']}/start", timeout=10)
 
 # Setup
-manager = api.BaseAPI(token = token)
+glacier = None
+succeeded = False
+manager = api.BaseAPI(token = token, endpoint = conf.get("api_endpoint"))
+async_manager = api.AsyncAPI(manager)
 pathlib.Path('backups/glacier/history').mkdir(parents=True, exist_ok=True)
 if not os.path.exists("backups/glacier/history/.git"):
     execute("git -C backups/glacier/history init")
 
 # Cleans up everything related to dosvob's execution
-def cleanup():
+async def cleanup_async():
+    # Each listing is read in full before deleting anything, since deleting shifts everything after it back a page
+    droplets, snapshots, volumes, keys = await asyncio.gather(
+        async_manager.paginate("droplets", "droplets", { 'tag_name': dosvob_ephemeral_tag }),
+        async_manager.paginate("snapshots", "snapshots"),
+        async_manager.paginate("volumes", "volumes"),
+        async_manager.paginate("account/keys", "ssh_keys"))
+
     # Clear droplets first because they might mount volumes
-    for droplet in manager.request("droplets", "GET", { 'tag_name': dosvob_ephemeral_tag })["droplets"]:
-        manager.request(f"droplets/{droplet['id']}", "DELETE")
+    await asyncio.gather(*(async_manager.request(f"droplets/{droplet['id']}", "DELETE") for droplet in droplets))
 
     # Clear snapshots next to give volumes time to demount properly (this may or may not be helpful; if it is, solve it better)
-    for snapshot in filter(has_dosvob_ephemeral_tag, manager.request("snapshots", "GET")["snapshots"]):
-        manager.request(f"snapshots/{snapshot['id']}", "DELETE")
+    await asyncio.gather(*(async_manager.request(f"snapshots/{snapshot['id']}", "DELETE") for snapshot in filter(has_dosvob_ephemeral_tag, snapshots)))
 
     # Clear volumes once the droplet is probably shut down
     # For some reason, tagging volumes doesn't seem to work right, so we do it with name prefixes instead
-    for volume in filter(lambda item: item["name"].startswith(dosvob_ephemeral_tag), manager.request("volumes", "GET")["volumes"]):
-        manager.request(f"volumes/{volume['id']}", "DELETE")
-    
+    await asyncio.gather(*(async_manager.request(f"volumes/{volume['id']}", "DELETE")
+        for volume in filter(lambda item: item["name"].startswith(dosvob_ephemeral_tag), volumes)))
+
     # Clear SSH keys that we inserted
-    actionresult = manager.request(f"account/keys", "GET")
-    for key in actionresult["ssh_keys"]:
-        if key["name"] == dosvob_key_name:
-            manager.request(f"account/keys/{key['id']}", "DELETE")
+    await asyncio.gather(*(async_manager.request(f"account/keys/{key['id']}", "DELETE") for key in keys if key["name"] == dosvob_key_name))
+
+def cleanup():
+    asyncio.run(cleanup_async())
 
 try:
     # Waits for an action to be complete
     def waitfor(id):
-        while True:
-            actionresult = manager.request(f"actions/{id}", "GET")
-            if actionresult["action"]["status"] == "completed":
-                return
-            elif actionresult["action"]["status"] == "in-progress":
-                time.sleep(5)
-            else:
-                raise RuntimeError
+        manager.wait_for_action(id)
 
     # Clean up first, just so we're not stomping all over an old process
-    cleanup()
+    with phase("cleanup before run"):
+        cleanup()
 
     # Insert our SSH key
     sshkeyid = manager.request(f"account/keys", "POST", {
@@ -69,94 +74,222 @@ try:
             'public_key': pathlib.Path("~/.ssh/id_rsa.pub").expanduser().read_text(),
         })["ssh_key"]["id"]
 
-    # Build the droplet that we'll be using for rsync
-    workerresponse = manager.request("droplets", "POST", {
-            'name': f'{dosvob_ephemeral_tag}-worker',
-            'region': region,
-            'image': 'debian-12-x64',
-            'size': 's-1vcpu-1gb',
-            'tags': [ dosvob_ephemeral_tag ],
-            'ssh_keys': [ sshkeyid ],
-        })
-    workerid = workerresponse["droplet"]["id"]
-    waitfor(workerresponse["links"]["actions"][0]["id"])
-
-    # Droplet starts in a powered-on state
-
-    # Get the external IP so we can connect to it
-    workeriplist = manager.request(f"droplets/{workerid}", "GET")["droplet"]["networks"]["v4"]
-    workerip = next(x for x in workeriplist if x["type"] == "public")["ip_address"]
-    print(f"Worker found at IP {workerip}")
-
-    # Install go, which we need for diskrsync; this also accepts our ssh key
-    # we actually need to retry every second until we succeed because it now takes a bit for the server to come up
-    while True:
-        try:
-            execute(f"ssh -o StrictHostKeyChecking=no root@{workerip} apt install -y golang")
-            break
-        except:
-            time.sleep(1)
-    
-    # And now get diskrsync copied over
-    execute(f"scp /usr/local/bin/diskrsync root@{workerip}:/usr/local/bin/diskrsync")
+    # A prepared image (a snapshot of a worker that already has diskrsync) saves copying it over every time
+    worker_conf = conf.get("worker", {})
+
+    # Makes a worker droplet in a region and gets it ready to run diskrsync; returns its ID and IP
+    def create_worker(region):
+        workerrequest = {
+                'name': f'{dosvob_ephemeral_tag}-worker-{region}',
+                'region': region,
+                'image': worker_conf.get("image") or 'debian-12-x64',
+                'size': worker_conf.get("size", 's-1vcpu-1gb'),
+                'tags': [ dosvob_ephemeral_tag ],
+                'ssh_keys': [ sshkeyid ],
+            }
+        if worker_conf.get("diskrsync_url"):
+            # Have the droplet fetch diskrsync itself while it boots, instead of waiting for ssh to push it over
+            workerrequest['user_data'] = f"#!/bin/sh\ncurl -fsSL -o /usr/local/bin/diskrsync.tmp '{worker_conf['diskrsync_url']}' && chmod +x /usr/local/bin/diskrsync.tmp && mv /usr/local/bin/diskrsync.tmp /usr/local/bin/diskrsync\n"
+
+        # Build the droplet that we'll be using for rsync
+        with phase("create worker", region=region):
+            workerresponse = manager.request("droplets", "POST", workerrequest)
+            workerid = workerresponse["droplet"]["id"]
+            waitfor(workerresponse["links"]["actions"][0]["id"])
+
+        # Droplet starts in a powered-on state
+
+        # Get the external IP so we can connect to it
+        workeriplist = manager.request(f"droplets/{workerid}", "GET")["droplet"]["networks"]["v4"]
+        workerip = next(x for x in workeriplist if x["type"] == "public")["ip_address"]
+        print(f"Worker for {region} found at IP {workerip}")
+
+        # Wait for sshd to come up; this also accepts the worker's host key
+        with phase("wait for ssh", region=region):
+            ssh_timeout = worker_conf.get("ssh_timeout", 300)
+            deadline = time.monotonic() + ssh_timeout
+            delay = 1
+            while True:
+                try:
+                    execute(f"ssh -o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=10 root@{workerip} true")
+                    break
+                except RuntimeError:
+                    if time.monotonic() + delay > deadline:
+                        raise RuntimeError(f"Worker at {workerip} didn't accept ssh within {ssh_timeout}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 15)
+
+        # And now get diskrsync over there, if the image or cloud-init didn't already
+        with phase("install diskrsync", region=region):
+            try:
+                if worker_conf.get("diskrsync_url"):
+                    execute(f"ssh root@{workerip} 'test -x /usr/local/bin/diskrsync || cloud-init status --wait >/dev/null; test -x /usr/local/bin/diskrsync'")
+                else:
+                    execute(f"ssh root@{workerip} test -x /usr/local/bin/diskrsync")
+            except RuntimeError:
+                execute(f"scp /usr/local/bin/diskrsync root@{workerip}:/usr/local/bin/diskrsync")
+
+        return workerid, workerip
 
     snapshotslug = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
 
-    # Traverse over all volumes
-    volumes = manager.request("volumes", "GET")["volumes"]
-    for volume in volumes:
+    glacier = GlacierPass("backups", conf["snapshot_retention"], **conf.get("glacier", {}))
+
+    # Volumes go through the pipeline several at a time, so the snapshot and volume copy for the next one are being made while
+    # the current one transfers. Transfers have their own, smaller limit, since they're usually fighting over the same disk.
+    # A droplet can only have 7 volumes attached at once.
+    volumes_in_flight = min(conf.get("volumes_in_flight", 2), 7)
+
+    # Images diskrsync finished with. If a run fails partway, only these get archived; the rest could be half-updated, so they keep the
+    # manifest from their last good run.
+    transferred = set()
+
+    def backup_volume(volume, backup_name, workerid, workerip, transfers, worker_actions):
         # Snapshot a volume
         # Volume name length limited to 64 so we unfortunately have to limit our embedded name
-        name = f"dosvob-ephemeral--{volume['name'][:12]}--{snapshotslug}"
-        result = manager.request(f"volumes/{volume['id']}/snapshots", "POST", {
-                'name': name,
-                'tags': [ dosvob_ephemeral_tag ],
-            })["snapshot"]
+        # Names have to be unique within a region, and several volumes are in flight at once, so a bit of the volume's ID goes in too;
+        # that also keeps the /dev/disk/by-id path of each copy unambiguous
+        name = f"dosvob-ephemeral--{volume['name'][:12]}--{volume['id'][:8]}--{snapshotslug}"
+        with phase("snapshot and copy", volume=backup_name):
+            result = manager.request(f"volumes/{volume['id']}/snapshots", "POST", {
+                    'name': name,
+                    'tags': [ dosvob_ephemeral_tag ],
+                })["snapshot"]
         
-        # Make a volume from our snapshot
-        snapshotid = result["id"]
-        volumecopy = manager.request("volumes", "POST", {
-                'name': name,
-                'size_gigabytes': result["min_disk_size"],
-                'snapshot_id': snapshotid,
-                'tags': [ dosvob_ephemeral_tag ],
-            })["volume"]
-        volumecopyid = volumecopy["id"]
-        
-        # Wipe the snapshot
-        manager.request(f"snapshots/{snapshotid}", "DELETE")
-
-        # Attach the volume to our worker
-        waitfor(manager.request(f"volumes/{volumecopyid}/actions", "POST", {
-                'type': 'attach',
-                'droplet_id': workerid,
-            })["action"]["id"])
+            # Make a volume from our snapshot
+            snapshotid = result["id"]
+            volumecopy = manager.request("volumes", "POST", {
+                    'name': name,
+                    'size_gigabytes': result["min_disk_size"],
+                    'snapshot_id': snapshotid,
+                    'tags': [ dosvob_ephemeral_tag ],
+                })["volume"]
+            volumecopyid = volumecopy["id"]
         
-        # Volume always shows up as sda, so let's sync it over
-        execute(f"diskrsync --verbose --calc-progress --sync-progress --no-compress root@{workerip}:/dev/sda backups/{volume['name']}")
-
-        # Detach volume
-        waitfor(manager.request(f"volumes/{volumecopyid}/actions", "POST", {
-                'type': 'detach',
-                'droplet_id': workerid,
-            })["action"]["id"])
+            # Wipe the snapshot
+            manager.request(f"snapshots/{snapshotid}", "DELETE")
+
+        with transfers:
+            # Attach the volume to our worker
+            with worker_actions, phase("attach", volume=backup_name):
+                waitfor(manager.request(f"volumes/{volumecopyid}/actions", "POST", {
+                        'type': 'attach',
+                        'droplet_id': workerid,
+                    })["action"]["id"])
+
+            # With more than one volume attached, there's no telling which sdX is which, but udev names them after the volume
+            device = f"/dev/disk/by-id/scsi-0DO_Volume_{volumecopy['name']}"
+            execute(f"ssh -o StrictHostKeyChecking=no root@{workerip} 'timeout 60 sh -c \"until [ -e {device} ]; do sleep 1; done\"'")
+
+            with phase("transfer", volume=backup_name):
+                usage = execute(f"diskrsync --verbose --calc-progress --sync-progress --no-compress root@{workerip}:{device} backups/{backup_name}")
+            # what diskrsync wrote to the local disk, which is just the blocks that changed; what came over the network isn't measured
+            metrics.add(backup_name, bytes_synced=os.path.getsize(f"backups/{backup_name}"), bytes_written=usage.ru_oublock * 512)
+
+            # Turn runs of zeros back into holes; diskrsync only writes blocks that changed, so they stay holes from then on
+            if conf.get("sparse_backups", False):
+                execute(f"fallocate --dig-holes backups/{backup_name}")
+            transferred.add(backup_name)
+
+            # Archive it now, while it's still in the page cache, rather than reading it all back off the disk at the end
+            if conf.get("glacier_after_sync", False):
+                glacier.submit(backup_name)
+
+            # Detach volume
+            with worker_actions, phase("detach", volume=backup_name):
+                waitfor(manager.request(f"volumes/{volumecopyid}/actions", "POST", {
+                        'type': 'detach',
+                        'droplet_id': workerid,
+                    })["action"]["id"])
         
         # Delete volume
         manager.request(f"volumes/{volumecopyid}", "DELETE")
 
-    do_glacier_pass("backups", conf["snapshot_retention"])
+    # Everything for one region: bring up a worker there, then push its volumes through the pipeline
+    def backup_region(region, region_volumes):
+        workerid, workerip = create_worker(region)
+
+        transfers = threading.Semaphore(conf.get("parallel_transfers", 1))
+        # DigitalOcean won't run two attach/detach actions on one droplet at the same time
+        worker_actions = threading.Lock()
+
+        with phase("all volumes", region=region), ThreadPoolExecutor(max_workers=volumes_in_flight) as pipeline:
+            futures = [pipeline.submit(backup_volume, volume, backup_name, workerid, workerip, transfers, worker_actions)
+                for backup_name, volume in region_volumes]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except:
+                # Don't start anything new; the ones already running finish up before we get to cleanup
+                for future in futures:
+                    future.cancel()
+                raise
+
+    # Volumes can only be attached to droplets in their own region, so every region gets its own worker
+    # Volume names are only unique within a region, so if a name shows up in more than one, the region goes in the backup's name
+    volumes = list(manager.paginate("volumes", "volumes"))
+    name_regions = {}
+    for volume in volumes:
+        name_regions.setdefault(volume["name"], set()).add(volume["region"]["slug"])
+    # conf.json from before there was a worker per region has a single "region"; that's still the only one it wants backed up
+    wanted_regions = conf.get("regions") or ([conf["region"]] if conf.get("region") else None)
+    regions = {}
+    for volume in volumes:
+        region = volume["region"]["slug"]
+        if wanted_regions and region not in wanted_regions:
+            continue
+        backup_name = volume["name"] if len(name_regions[volume["name"]]) == 1 else f"{volume['name']}-{region}"
+        regions.setdefault(region, []).append((backup_name, volume))
+
+    # Regions all run at once, so the whole thing takes as long as the slowest one. A region failing doesn't stop the others.
+    region_results = {}
+    with phase("all regions"), ThreadPoolExecutor(max_workers=max(len(regions), 1)) as region_pool:
+        futures = {region_pool.submit(backup_region, region, region_volumes): region for region, region_volumes in regions.items()}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                future.result()
+                region_results[region] = f"{len(regions[region])} volumes ok"
+            except Exception as error:
+                region_results[region] = f"failed: {error!r}"
+                print(f"Region {region} failed: {error!r}")
+    region_summary = "\n".join(f"{region}: {result}" for region, result in sorted(region_results.items()))
+    print(region_summary)
+    if any(result.startswith("failed") for result in region_results.values()):
+        # Whatever did make it still goes into the glacier before we report the failure
+        with phase("glacier"):
+            glacier.finish(transferred)
+        raise RuntimeError(f"Some regions failed:\n{region_summary}")
+
+    with phase("glacier"):
+        glacier.finish()
+    succeeded = True
 
     if conf["healthchecks"] != "":
-        requests.get(f"{conf['healthchecks']}", timeout=10)
+        requests.post(f"{conf['healthchecks']}", data=f"{region_summary}\n\n{metrics.summary()}", timeout=10)
 
-except:
+except BaseException as error:
     print("Error! Cleaning up before returning.")
     if conf["healthchecks"] != "":
-        requests.get(f"{conf['healthchecks']}/fail", timeout=10)
+        requests.post(f"{conf['healthchecks']}/fail", data=str(error), timeout=10)
     raise
 finally:
+    # If we bailed out partway, stop archiving; whatever manifests got written are picked up next run
+    if glacier is not None:
+        glacier.close()
+
     # Cleanup everything remaining
-    cleanup()
+    with phase("cleanup after run"):
+        cleanup()
+
+    async_manager.close()
+
+    print("Timings:")
+    print_timings()
+
+    # Where the time and the bytes went, for looking back at later or for node_exporter to pick up
+    metrics_conf = conf.get("metrics", {})
+    metrics.write(metrics_conf.get("report", "backups/glacier/report.json"), metrics_conf.get("prometheus"), "ok" if succeeded else "failed")
 
     # this is here entirely so I can easily comment out the cleanup when I'm developing :V
     pass
@@ -0,0 +1,266 @@
+import fcntl
+import heapq
+import json
+import os
+import time
+
+from chunkstore import LooseStore, PackStore
+from history import GitHistory, checked_out_manifests
+
+# Garbage collection for the chunk store.
+#
+# Mark: read every manifest in every commit still in the history repo, plus whatever is checked out, and collect the digests they
+# reference. Digests pile up in a set until there are too many, then get spilled to disk as a sorted run; at the end the runs are merged
+# into glacier/gc/reachable, a sorted array of raw digests. Memory use is bounded by the spill size, not by the size of the store.
+#
+# Sweep: walk each store's digests in sorted order alongside the reachable file. Unreferenced loose chunks get deleted; packs that are
+# mostly garbage get their live chunks copied into a fresh pack and are then deleted whole.
+#
+# Everything is checkpointed in glacier/gc/state.json, so a run that's interrupted, or that hits its time limit, picks up where it left
+# off next time, as long as no backup has happened in between. A backup holds a shared lock on glacier/lock and gc holds an exclusive one,
+# so the two never run at the same time.
+
+spill_digests = 4*1024*1024  # 128mb of digests, plus set overhead
+
+def lock_glacier(glacier_dir, exclusive):
+    """Takes glacier/lock, shared for backups and exclusive for gc. Returns the open lock file; closing it releases the lock."""
+    lock_file = open(os.path.join(glacier_dir, "lock"), 'a')
+    try:
+        fcntl.flock(lock_file, (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f"{glacier_dir} is in use by a backup")
+    return lock_file
+
+def read_digests(path):
+    """Yields the raw digests in a sorted digest file."""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(32 * 65536)
+            if not block:
+                return
+            for i in range(0, len(block), 32):
+                yield block[i:i + 32]
+
+def unreachable(digests, reachable_path):
+    """Yields the digests from a sorted iterable that aren't in the reachable file."""
+    reachable = read_digests(reachable_path)
+    current = next(reachable, None)
+    for digest in digests:
+        while current is not None and current < digest:
+            current = next(reachable, None)
+        if current != digest:
+            yield digest
+
+class GarbageCollector(object):
+    def __init__(self, glacier_dir, dry_run=False, repack_threshold=0.3, time_limit=None):
+        self.glacier_dir = glacier_dir
+        self.history_dir = os.path.join(glacier_dir, "history")
+        self.gc_dir = os.path.join(glacier_dir, "gc")
+        self.state_path = os.path.join(self.gc_dir, "state.json")
+        self.reachable_path = os.path.join(self.gc_dir, "reachable")
+        self.dry_run = dry_run
+        self.repack_threshold = repack_threshold
+        self.deadline = time.monotonic() + time_limit if time_limit else None
+        self.state = None
+
+    def _out_of_time(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def _save_state(self):
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+
+    def _generation(self, history):
+        """Identifies the set of manifests gc is working from: the newest commit, plus every checked-out manifest and its mtime.
+        If this changes, a backup has run, and anything marked so far can't be trusted."""
+        snapshots = history.snapshots()
+        head = list(snapshots.values())[-1] if snapshots else None
+        checked_out = [f"{name}:{os.stat(os.path.join(self.history_dir, name)).st_mtime_ns}" for name in checked_out_manifests(self.history_dir)]
+        return [head] + checked_out
+
+    def _spill(self, digests):
+        path = os.path.join(self.gc_dir, f"mark-{len(self.state['runs']):06d}")
+        with open(path, 'wb') as f:
+            f.write(b"".join(sorted(digests)))
+        self.state['runs'].append(path)
+
+    def mark(self, history):
+        """Builds the reachable file, resuming a half-finished mark if there is one. Returns False if it ran out of time first."""
+        digests = set()
+        for key, manifest in history.retained_manifests(skip=self.state['marked']):
+            digests.update(digest for digest, length in manifest.chunk_digests())
+            self.state['marked'].append(key)
+            if len(digests) >= spill_digests:
+                # checkpoint: the run and the list of what's in it have to land together
+                self._spill(digests)
+                digests.clear()
+                self._save_state()
+            if self._out_of_time():
+                if digests:
+                    self._spill(digests)
+                self._save_state()
+                return False
+        if digests:
+            self._spill(digests)
+
+        # merge the runs into one sorted, deduplicated array
+        temp_path = f"{self.reachable_path}.tmp"
+        count = 0
+        with open(temp_path, 'wb') as f:
+            previous = None
+            for digest in heapq.merge(*(read_digests(path) for path in self.state['runs'])):
+                if digest != previous:
+                    f.write(digest)
+                    count += 1
+                    previous = digest
+        os.replace(temp_path, self.reachable_path)
+        for path in self.state['runs']:
+            os.remove(path)
+        self.state['runs'] = []
+        self.state['marked'] = []
+        self.state['stage'] = "sweep"
+        self._save_state()
+        print(f"Marked {count} reachable chunks")
+        return True
+
+    def sweep_loose(self):
+        loose = LooseStore(self.glacier_dir)
+        if not os.path.isdir(loose.chunks_dir):
+            return
+        count = size = 0
+        try:
+            for digest in unreachable(sorted(loose._present()), self.reachable_path):
+                if self._out_of_time():
+                    break
+                hash = digest.hex()
+                location = loose.locate(hash)
+                if location is None:
+                    continue
+                count += 1
+                size += location[2]
+                if not self.dry_run:
+                    loose.remove(hash)
+        finally:
+            loose.close()
+        print(f"Loose: {count} unreferenced chunks, {size / 1024 / 1024:.1f}mb{' (dry run, nothing deleted)' if self.dry_run else ' deleted'}")
+
+    def sweep_packs(self):
+        packs_dir = os.path.join(self.glacier_dir, "packs")
+        if not os.path.isdir(packs_dir):
+            return
+        store = PackStore(self.glacier_dir, readonly=self.dry_run)
+
+        dead = set(unreachable(sorted(store.entries), self.reachable_path))
+        pack_live = {}
+        pack_dead = {}
+        for digest, (pack, offset, length, codec) in store.entries.items():
+            totals = pack_dead if digest in dead else pack_live
+            totals[pack] = totals.get(pack, 0) + length
+
+        # packs that no index entry points at are left over from a repack that got interrupted after the index was rewritten
+        for name in sorted(os.listdir(packs_dir)):
+            if name.startswith("pack-") and name.endswith(".pack"):
+                number = int(name[len("pack-"):-len(".pack")])
+                if number not in pack_live and number not in pack_dead:
+                    print(f"Removing orphaned {name}")
+                    if not self.dry_run:
+                        os.remove(os.path.join(packs_dir, name))
+
+        repack = sorted(pack for pack, garbage in pack_dead.items()
+            if garbage >= self.repack_threshold * (garbage + pack_live.get(pack, 0)))
+        reclaimable = sum(pack_dead[pack] for pack in repack)
+        print(f"Packs: {len(dead)} unreferenced chunks, {sum(pack_dead.values()) / 1024 / 1024:.1f}mb; "
+            f"{len(repack)} packs over the repack threshold, {reclaimable / 1024 / 1024:.1f}mb reclaimable")
+        if self.dry_run or not repack:
+            store.close()
+            return
+
+        # live chunks always go into brand new packs, never into one we might be about to delete
+        first_new_pack = max(pack for pack, offset, length, codec in store.entries.values()) + 1
+        try:
+            for pack in repack:
+                if self._out_of_time():
+                    break
+                moving = [digest for digest, entry in store.entries.items() if entry[0] == pack]
+                for digest in moving:
+                    if digest in dead:
+                        continue
+                    codec, payload = store.read_stored(digest.hex())
+                    if store.pack_file is None:
+                        with store.lock:
+                            store._new_pack(first_new_pack)
+                    del store.entries[digest]
+                    store.put_stored(digest.hex(), codec, payload)
+                for digest in moving:
+                    if digest in dead:
+                        del store.entries[digest]
+                # copies are durable before the index stops pointing at the originals, and the index is rewritten before the pack goes
+                with store.lock:
+                    store._sync()
+                    store._write_index()
+                os.remove(store.pack_path(pack))
+                print(f"Repacked pack {pack}: dropped {pack_dead[pack] / 1024 / 1024:.1f}mb, kept {pack_live.get(pack, 0) / 1024 / 1024:.1f}mb")
+        finally:
+            store.close()
+
+    def run(self):
+        os.makedirs(self.gc_dir, exist_ok=True)
+        lock = lock_glacier(self.glacier_dir, exclusive=True)
+        try:
+            history = GitHistory(self.history_dir, refresh_seconds=0)
+            generation = self._generation(history)
+            try:
+                with open(self.state_path) as f:
+                    self.state = json.load(f)
+            except FileNotFoundError:
+                pass
+            if self.state is None or self.state['generation'] != generation:
+                if self.state is not None:
+                    print("Backups have run since the last gc, starting over")
+                    for path in self.state['runs']:
+                        if os.path.exists(path):
+                            os.remove(path)
+                self.state = { 'generation': generation, 'stage': "mark", 'marked': [], 'runs': [] }
+                self._save_state()
+            elif self.state['stage'] == "mark" and self.state['marked']:
+                print(f"Resuming mark with {len(self.state['marked'])} manifests already done")
+            else:
+                print("Resuming sweep")
+
+            marked = self.state['stage'] != "mark" or self.mark(history)
+            history.close()
+            if not marked:
+                print("Out of time while marking; the next gc will carry on from here")
+                return
+
+            self.sweep_loose()
+            self.sweep_packs()
+            if self._out_of_time():
+                print("Out of time; the next gc will carry on from here")
+            elif not self.dry_run:
+                # all done; next time starts with a fresh mark
+                os.remove(self.state_path)
+                os.remove(self.reachable_path)
+        finally:
+            lock.close()
+
+def collect_garbage(glacier_dir, dry_run=False, repack_threshold=0.3, time_limit=None):
+    GarbageCollector(glacier_dir, dry_run, repack_threshold, time_limit).run()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Delete chunks that no retained manifest refers to')
+    parser.add_argument('glacier_dir', type=str, help='Glacier directory, usually backups/glacier')
+    parser.add_argument('--dry-run', action='store_true', help='Report how much could be reclaimed without deleting anything')
+    parser.add_argument('--repack-threshold', type=float, default=0.3, help='Repack a pack once this fraction of it is garbage')
+    parser.add_argument('--time-limit', type=float, default=None, help='Stop after this many seconds; the next run resumes')
+
+    args = parser.parse_args()
+
+    collect_garbage(args.glacier_dir, args.dry_run, args.repack_threshold, args.time_limit)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,21 @@
 
+import bisect
 import hashlib
-import subprocess
+import itertools
+import queue
+import threading
 import time
 import os
+import struct
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
+from chunkstore import open_store
 from datetime import datetime, timedelta
-from util import execute
+from garbage import collect_garbage, lock_glacier
+from history import commit_snapshot, convert_to_snapshot_refs, delete_snapshots, list_snapshots
+from manifest import Manifest, zero_hash
+from metrics import metrics
 
 def parse_duration(duration_str):
     """Convert a duration string into a timedelta object."""
@@ -29,104 +39,88 @@ def parse_duration(duration_str):
     else:
         raise ValueError(f"Unsupported time unit: {unit}")
 
-def filter_snapshots(snapshots, kept_ids, retention_policy):
-    """Filter snapshots based on the retention policy."""
-    now = datetime.now()
-    
-    if 'last' in retention_policy:
-        # just shove the recent ones in, done
-        kept_ids.update([snapshot[1] for snapshot in snapshots[-retention_policy['last']:]])
-    else:
-        frequency = parse_duration(retention_policy['frequency'])
-        duration = parse_duration(retention_policy['duration'])
-        print("====== ", frequency, duration, "======")
-        print(retention_policy)
-        
-        last_kept = None
-        last_seen = None
-
-        for snapshot in snapshots:
-            if now - snapshot[0] > duration:
-                # we're done here
-                break
+# Retention
+#
+# Snapshots are (datetime, commit) tuples, newest first. Each policy is a stage that snapshots stream through, marking the ones it wants
+# to keep, and the stages are chained, so every policy is evaluated in a single pass over the list and later policies see what earlier
+# ones kept. A frequency policy can decide to keep the snapshot before the one it's looking at, so each stage holds one snapshot back
+# until it's sure.
 
-            if snapshot[1] in kept_ids:
+def keep_last(stream, count):
+    """Keeps the newest count snapshots."""
+    for index, (snapshot, kept) in enumerate(stream):
+        yield snapshot, kept or index < count
+
+def keep_every(stream, frequency, duration, now):
+    """Walks back through the last duration, keeping a snapshot at least every frequency. Where there's a gap, it keeps the snapshot
+    just before the gap rather than the one after it, so the kept ones stay as close to frequency apart as they can."""
+    last_kept = None
+    last_seen = None
+    pending = None  # [snapshot, kept], held back in case the next one decides to keep it
+    expired = False
+    for snapshot, kept in stream:
+        if not expired and now - snapshot[0] > duration:
+            # everything from here on is too old for this policy
+            expired = True
+        if not expired:
+            if kept:
                 last_kept = snapshot
-                last_seen = snapshot
-                continue
-
-            print(last_kept, snapshot, last_seen, frequency)
-            if last_kept is not None:
-                print(last_kept[0] - snapshot[0])
-            
-            if last_kept is None or last_kept[0] - snapshot[0] > frequency:
-                # we need to add something!
+            elif last_kept is None or last_kept[0] - snapshot[0] > frequency:
                 if last_seen is None or last_seen == last_kept:
-                    # we *want* to add one in the middle, but we don't have one, so we'll add this one I guess
-                    last_seen = snapshot
-                
-                # add last_seen
-                print("yoink")
-                kept_ids.add(last_seen[1])
-                last_kept = last_seen
-            
+                    # we *want* to keep one in the middle, but we don't have one, so we'll keep this one
+                    kept = True
+                    last_kept = snapshot
+                else:
+                    # last_seen is always the previous snapshot, which is the one we're holding back
+                    pending[1] = True
+                    last_kept = last_seen
             last_seen = snapshot
+        if pending is not None:
+            yield tuple(pending)
+        pending = [snapshot, kept]
+    if pending is not None:
+        yield tuple(pending)
 
-    return kept_ids
-
-def get_kept_snapshot_ids(snapshots, retention_policies):
-    """Determine which snapshots to keep based on retention policies."""
-    kept_ids = set()
-
+def kept_snapshots(snapshots, retention_policies, now=None):
+    """The commits the retention policies keep, out of (datetime, commit) tuples sorted newest first."""
+    now = now or datetime.now()
+    stream = ((snapshot, False) for snapshot in snapshots)
     for policy in retention_policies:
-        filter_snapshots(snapshots, kept_ids, policy)
-
-    return kept_ids
-
-def clear_git_retention(gitdir, retention_policies):
-    """Retrieve git commits as (timestamp, commit hash) tuples."""
-    # Define the command to get commit hashes and their author date in UNIX timestamp format
-    command = ['git', '-C', gitdir, '--no-replace-objects', 'log', '--pretty=format:%at %H']
-    result = subprocess.run(command, capture_output=True, text=True, check=True)
-    
-    # Parse the output
-    snapshots = []
-    for line in result.stdout.split('\n'):
-        if line:
-            timestamp, commit_hash = line.split()
-            timestamp = datetime.fromtimestamp(int(timestamp))
-            snapshots.append((timestamp, commit_hash))
-    
-    # Get the commit hashes
-    to_keep = get_kept_snapshot_ids(snapshots, retention_policies)
-
-    # sort to_keep by timestamp, so we can see what's going on
-    to_keep = sorted(to_keep, key=lambda commit: snapshots[[snapshot[1] for snapshot in snapshots].index(commit)][0])
-
-    # now print them all, including the time since the last timestamp
-    last_timestamp = None
-    for commit in to_keep:
-        timestamp = snapshots[[snapshot[1] for snapshot in snapshots].index(commit)][0]
-        if last_timestamp is not None:
-            print(f"{commit} ({timestamp - last_timestamp})")
+        if 'last' in policy:
+            stream = keep_last(stream, policy['last'])
         else:
-            print(f"{commit}")
-        last_timestamp = timestamp
-
-    # Convert the list into a format suitable for the git filter-repo command
-    commits_to_keep_str = ','.join([f"'{tk}'" for tk in to_keep])
+            stream = keep_every(stream, parse_duration(policy['frequency']), parse_duration(policy['duration']), now)
+    return set(snapshot[1] for snapshot, kept in stream if kept)
 
-    # Command to run git filter-repo with a commit callback
-    filter_repo_command = f"""
-        git filter-repo --force --commit-callback "if commit.original_id.decode('utf-8') not in {{{commits_to_keep_str}}}:
-            commit.skip()
-        "
-    """
+def apply_retention(gitdir, retention_policies, dry_run=False, now=None):
+    """Delete the snapshots no retention policy wants. Returns the number deleted."""
+    if not retention_policies:
+        # no policies means no retention, not deleting everything
+        return 0
+    if not dry_run:
+        convert_to_snapshot_refs(gitdir)
+    snapshots = list_snapshots(gitdir)
+    newest_first = [(datetime.fromtimestamp(timestamp), commit) for timestamp, commit, ref in reversed(snapshots)]
+    kept = kept_snapshots(newest_first, retention_policies, now)
+    # whatever the policies say, the newest snapshot is what's checked out, so it stays
+    if snapshots:
+        kept.add(snapshots[-1][1])
 
-    print(filter_repo_command)
+    # show what's left, with the gap to the one before it, so we can see what's going on
+    last_timestamp = None
+    deleting = []
+    for timestamp, commit, ref in snapshots:
+        if commit not in kept:
+            deleting.append(ref)
+            continue
+        timestamp = datetime.fromtimestamp(timestamp)
+        print(f"{commit} {timestamp}" + (f" (+{timestamp - last_timestamp})" if last_timestamp is not None else ""))
+        last_timestamp = timestamp
+    print(f"Retention keeps {len(snapshots) - len(deleting)} of {len(snapshots)} snapshots")
 
-    # Execute the git filter-repo command
-    subprocess.run(filter_repo_command, cwd=gitdir, shell=True, check=True)
+    if not dry_run:
+        delete_snapshots(gitdir, deleting)
+    return len(deleting)
 
 def hash_chunk(chunk):
     """Hash a chunk of data using SHA256."""
@@ -134,44 +128,396 @@ def hash_chunk(chunk):
     hasher.update(chunk)
     return hasher.hexdigest()
 
+# Images are read front to back exactly once, so tell the kernel to read ahead aggressively, and drop what we've finished with so one
+# image going through doesn't push the next one (which may have only just been synced) out of the page cache.
+drop_cache_every = 64*1024*1024
+
+def advise_sequential(file):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+def drop_cache(file, start, end):
+    if hasattr(os, "posix_fadvise") and end > start:
+        os.posix_fadvise(file.fileno(), start, end - start, os.POSIX_FADV_DONTNEED)
+
 def chunkify_file(file_path, chunk_size=1024*1024):
     """Generator that reads a file in chunks."""
     with open(file_path, 'rb') as file:
+        advise_sequential(file)
+        dropped = position = 0
         while True:
             chunk = file.read(chunk_size)
             if not chunk:
                 break
+            position += len(chunk)
+            if position - dropped >= drop_cache_every:
+                drop_cache(file, dropped, position)
+                dropped = position
             yield chunk
 
-def store_chunk(chunk, hash, backupname):
-    """Store chunk under backupname/chunks/hash."""
-    chunks_dir = os.path.join(backupname, "glacier", "chunks", hash[:2])
-    os.makedirs(chunks_dir, exist_ok=True)
-    chunk_path = os.path.join(chunks_dir, hash)
-    # if it already exists, we're good
-    if os.path.exists(chunk_path):
+# Content-defined chunking
+#
+# Fixed 1mb chunks dedup great as long as data changes in place, but anything that shifts data around (resizing an image, inserting
+# into a file) changes every chunk after it. In cdc mode we cut chunks where the content says to instead, so boundaries move with the data.
+#
+# The rolling hash is a windowed gear sum: every byte maps to a random 32-bit value, and the hash at a position is the sum of those
+# values over the last 64 bytes. Unlike the classic shift-based gear hash, that's just a difference of two prefix sums, so it vectorizes
+# with numpy. Cut points follow FastCDC's normalized chunking: a stricter mask before the average size and a looser one after it,
+# with hard minimum and maximum sizes.
+try:
+    import numpy
+except ImportError:
+    # it's in the Pipfile, but chunking still works without it, just at a few mb/s
+    numpy = None
+
+cdc_window = 64
+cdc_gear = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], 'little') for value in range(256)]
+# hashes are worked out this many windows at a time, so what they cost in memory doesn't grow with the read buffer
+cdc_block = 256*1024
+
+def cdc_hashes(data):
+    """Rolling hash of every 64-byte window in data, indexed by the window's first byte. Needs numpy."""
+    gear = numpy.array(cdc_gear, dtype=numpy.uint32)
+    prefix = numpy.zeros(len(data) + 1, dtype=numpy.uint32)
+    numpy.cumsum(gear[numpy.frombuffer(data, dtype=numpy.uint8)], out=prefix[1:])
+    # uint32 wraps, which is exactly the arithmetic we want
+    return prefix[cdc_window:] - prefix[:-cdc_window] if len(data) >= cdc_window else numpy.zeros(0, dtype=numpy.uint32)
+
+def cdc_block_candidates(block, strict_mask, loose_mask):
+    """Window offsets in block where the rolling hash matches each mask, as (strict, loose).
+    The strict mask is a superset of the loose one's bits, so strict matches are picked out of the loose ones instead of rescanning."""
+    if numpy is not None:
+        hashes = cdc_hashes(block)
+        loose = numpy.flatnonzero((hashes & loose_mask) == 0)
+        strict = loose[(hashes[loose] & strict_mask) == 0]
+        return strict.tolist(), loose.tolist()
+    strict = []
+    loose = []
+    prefix = list(itertools.accumulate(map(cdc_gear.__getitem__, block), initial=0))
+    for index, (high, low) in enumerate(zip(itertools.islice(prefix, cdc_window, None), prefix)):
+        value = (high - low) & 0xffffffff
+        if value & loose_mask == 0:
+            loose.append(index)
+            if value & strict_mask == 0:
+                strict.append(index)
+    return strict, loose
+
+def cdc_candidates(data, strict_mask, loose_mask):
+    """Positions (as offsets of the first byte after the window) where the rolling hash matches each mask, as (strict, loose)."""
+    strict = []
+    loose = []
+    view = memoryview(data)
+    for start in range(0, max(len(data) - cdc_window + 1, 0), cdc_block):
+        # cdc_block windows, and the bytes the last of them reaches past the block
+        block_strict, block_loose = cdc_block_candidates(view[start:start + cdc_block + cdc_window - 1], strict_mask, loose_mask)
+        strict.extend(index + start + cdc_window for index in block_strict)
+        loose.extend(index + start + cdc_window for index in block_loose)
+    return strict, loose
+
+def cdc_cuts(data, min_size, avg_size, max_size, final):
+    """Chunk boundaries in data, which has to start at a chunk boundary. Returns the list of cut offsets;
+    if final is false, the tail past the last cut is left for the caller to carry over into the next buffer."""
+    bits = max(1, avg_size.bit_length() - 1)
+    strict, loose = cdc_candidates(data, (1 << (bits + 1)) - 1, (1 << (bits - 1)) - 1)
+
+    cuts = []
+    start = 0
+    while True:
+        remaining = len(data) - start
+        if remaining == 0 or (not final and remaining < max_size):
+            break
+        cut = None
+        # strict mask between min and average
+        index = bisect.bisect_left(strict, start + min_size)
+        if index < len(strict) and strict[index] < start + avg_size:
+            cut = strict[index]
+        else:
+            # loose mask between average and max
+            index = bisect.bisect_left(loose, start + avg_size)
+            if index < len(loose) and loose[index] < start + max_size:
+                cut = loose[index]
+            else:
+                cut = start + max_size
+        cut = min(cut, len(data))
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+def chunkify_file_cdc(file_path, min_size=256*1024, avg_size=1024*1024, max_size=4*1024*1024):
+    """Generator that reads a file in content-defined chunks."""
+    if min_size < cdc_window or not min_size <= avg_size <= max_size:
+        raise ValueError(f"Bad cdc chunk sizes: need {cdc_window} <= min <= avg <= max")
+    read_size = max(8 * 1024 * 1024, 2 * max_size)
+    with open(file_path, 'rb') as file:
+        advise_sequential(file)
+        dropped = 0
+        carry = b""
+        while True:
+            block = file.read(read_size)
+            # the carry is already in memory, so the whole block can go
+            drop_cache(file, dropped, file.tell())
+            dropped = file.tell()
+            final = not block
+            data = carry + block if carry else block
+            start = 0
+            for cut in cdc_cuts(data, min_size, avg_size, max_size, final):
+                yield data[start:cut]
+                start = cut
+            carry = data[start:]
+            if final:
+                break
+
+class Chunker(object):
+    """How an image gets split into chunks. ident goes into the sidecar so incremental passes notice if the chunking changes."""
+    def __init__(self, chunking="fixed", chunk_size=1024*1024, min_chunk=256*1024, avg_chunk=1024*1024, max_chunk=4*1024*1024):
+        self.chunking = chunking
+        if chunking == "fixed":
+            self.ident = chunk_size
+            self.chunkify = lambda path: chunkify_file(path, chunk_size)
+        elif chunking == "cdc":
+            if numpy is None:
+                print("numpy isn't installed, so content-defined chunking will be dozens of times slower than it should be")
+            self.ident = (1 << 63) | zlib.crc32(f"cdc {min_chunk} {avg_chunk} {max_chunk}".encode())
+            self.chunkify = lambda path: chunkify_file_cdc(path, min_chunk, avg_chunk, max_chunk)
+        else:
+            raise ValueError(f"Unsupported chunking: {chunking}")
+
+# All-zero chunks never get hashed or stored; the manifest records them as zero_hash and readers make up the zeros themselves.
+zero_chunk = bytes(1024*1024)
+
+def is_zero_chunk(chunk):
+    # bytes comparison bails out on the first differing byte, so this is nearly free for real data and a memcmp for empty space
+    if len(chunk) == len(zero_chunk):
+        return chunk == zero_chunk
+    return chunk == bytes(len(chunk))
+
+def prepare_chunk(chunk, chunks):
+    """Returns (hash, stored).
+
+    stored is the (codec, payload) that needs to go into the store, or None if the chunk is all zeros or the store already has it;
+    compressing here means it happens on the hashing pool instead of the writer thread."""
+    if is_zero_chunk(chunk):
+        return zero_hash, None
+    hash = hash_chunk(chunk)
+    return hash, chunks.prepare(hash, chunk)
+
+def read_manifest(history_file_path):
+    """Read a manifest as a list of hashes, or None if there isn't one."""
+    if not os.path.isfile(history_file_path):
+        return None
+    return Manifest.load(history_file_path).hashes()
+
+# Sidecar index: per-image record of what the image looked like the last time we manifested it.
+# It's magic, version, chunker ident, image size, image mtime, and chunk count. Version 1 sidecars also had a fingerprint per chunk
+# after the header; those get ignored, but the header is still good.
+sidecar_header = struct.Struct("<4sIQQqQ")
+sidecar_magic = b"DVSI"
+
+def read_sidecar(sidecar_path):
+    """Returns (chunker ident, size, mtime_ns, chunk count), or None if there's no usable sidecar."""
+    try:
+        with open(sidecar_path, 'rb') as f:
+            header = f.read(sidecar_header.size)
+    except FileNotFoundError:
+        return None
+    if len(header) != sidecar_header.size:
+        return None
+    magic, version, ident, size, mtime_ns, count = sidecar_header.unpack(header)
+    if magic != sidecar_magic or version not in (1, 2):
+        return None
+    return ident, size, mtime_ns, count
+
+def write_sidecar(sidecar_path, ident, size, mtime_ns, count):
+    temp_path = f"{sidecar_path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(sidecar_header.pack(sidecar_magic, 2, ident, size, mtime_ns, count))
+    os.replace(temp_path, sidecar_path)
+
+def remove_sidecar(sidecar_path):
+    try:
+        os.remove(sidecar_path)
+    except FileNotFoundError:
+        pass
+
+def glacier_file(item_path, history_file_path, sidecar_path, chunks, hashers, window, incremental=True, chunker=None, manifest_format="binary", record_lengths=False):
+    """Chunk, hash, and store a single image, writing its manifest to history_file_path.
+
+    A reader thread pulls chunks off the disk, the shared hashers pool hashes them (hashlib drops the GIL, so this scales across cores),
+    and this thread stores them and writes the manifest in the original order.
+
+    If incremental is set and the sidecar agrees with the previous manifest, an image that hasn't been touched since the last pass isn't
+    read at all. Anything else gets every chunk hashed; chunks the store already has are just not stored again.
+
+    record_lengths forces text manifests to include every chunk's length, which readers need when chunks are stored compressed or
+    aren't all the same size. Binary manifests always have lengths."""
+    chunker = chunker or Chunker()
+    volume = os.path.basename(item_path)
+    start = time.monotonic()
+    stat = os.stat(item_path)
+    # only for counting how many chunks are the same as last time
+    old_hashes = read_manifest(history_file_path) or []
+    if incremental and old_hashes and read_sidecar(sidecar_path) == (chunker.ident, stat.st_size, stat.st_mtime_ns, len(old_hashes)):
+        # diskrsync didn't write anything, so the old manifest is still exactly right
+        print(f"{item_path} unchanged since last glacier pass, skipping")
+        metrics.add(volume, chunks=len(old_hashes), chunks_unchanged=len(old_hashes))
+        metrics.record_phase("glacier", time.monotonic() - start, volume=volume)
         return
-    
-    with open(chunk_path, 'wb') as chunk_file:
-        chunk_file.write(chunk)
 
-def do_glacier_pass(backupname, retention_policies):
+    # bounded, so a slow disk on the write side can't make us buffer the whole image in memory
+    pending = queue.Queue(maxsize=window)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        # blocks until there's room, unless the writer has given up on us
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for chunk in chunker.chunkify(item_path):
+                if not put((chunk, hashers.submit(prepare_chunk, chunk, chunks))):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            put(None)
+
+    readthread = threading.Thread(target=reader, name=f"glacier-reader-{os.path.basename(item_path)}", daemon=True)
+    readthread.start()
+
+    count = unchanged_chunks = hashed_chunks = stored_chunks = stored_bytes = 0
+    try:
+        manifest = Manifest()
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            chunk, future = item
+            hash, stored = future.result()
+            # another image can get a new chunk into the store between prepare and here, which makes it a dedup after all
+            if stored is not None and chunks.put_stored(hash, *stored):
+                stored_chunks += 1
+                stored_bytes += len(stored[1])
+            if hash != zero_hash:
+                hashed_chunks += 1
+            if count < len(old_hashes) and old_hashes[count] == hash:
+                unchanged_chunks += 1
+            count += 1
+            manifest.append(hash, len(chunk))
+    finally:
+        stop.set()
+        readthread.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = max(time.monotonic() - start, 0.001)
+    print(f"{item_path}: {hashed_chunks} of {count} chunks hashed, {unchanged_chunks} unchanged, {stored_chunks} new, "
+        f"{stat.st_size / 1024 / 1024 / elapsed:.1f}mb/s")
+    metrics.add(volume, chunks=count, chunks_unchanged=unchanged_chunks, chunks_zero=count - hashed_chunks, chunks_hashed=hashed_chunks,
+        chunks_stored=stored_chunks, chunks_deduped=hashed_chunks - stored_chunks, bytes_read=stat.st_size, bytes_stored=stored_bytes)
+
+    # the chunks have to be durable (and, for packs, indexed) before anything points at them; otherwise a crash could leave a manifest
+    # and sidecar that say this image is done, and the next pass would skip it without ever storing what it's missing
+    chunks.sync()
+    # the old sidecar goes first, so a crash between here and writing the new one can't pair it with the new manifest
+    remove_sidecar(sidecar_path)
+    manifest.write(history_file_path, manifest_format, record_lengths)
+    write_sidecar(sidecar_path, chunker.ident, stat.st_size, stat.st_mtime_ns, count)
+    metrics.record_phase("glacier", time.monotonic() - start, volume=volume)
+
+class GlacierPass(object):
+    """A glacier pass that images can be fed into one at a time, as soon as each is ready.
+
+    dosvob uses this to archive each image right after diskrsync finishes with it, while it's still in the page cache, instead of
+    reading every image back off the disk at the end. finish() picks up whatever wasn't submitted and commits the manifests.
+
+    Options are the same as do_glacier_pass."""
+    def __init__(self, backupname, retention_policies, threads=None, parallel_files=2, window=64, incremental=True, store="loose", pack_size=1024*1024*1024,
+                 chunking="fixed", min_chunk=256*1024, avg_chunk=1024*1024, max_chunk=4*1024*1024, compression="none", compression_level=None,
+                 manifest_format="binary", apply_retention=False, collect_garbage=False):
+        self.backupname = backupname
+        self.retention_policies = retention_policies
+        self.window = window
+        self.incremental = incremental
+        self.manifest_format = manifest_format
+        self.apply_retention = apply_retention
+        self.collect_garbage = collect_garbage
+        # text manifests need lengths whenever chunks aren't all 1mb on disk
+        self.record_lengths = chunking != "fixed" or compression != "none"
+        os.makedirs(os.path.join(backupname, "glacier", "index"), exist_ok=True)
+        # keeps gc from deleting chunks out from under us
+        self.lock_file = lock_glacier(os.path.join(backupname, "glacier"), exclusive=False)
+
+        self.chunker = Chunker(chunking, min_chunk=min_chunk, avg_chunk=avg_chunk, max_chunk=max_chunk)
+        options = { 'pack_size': pack_size } if store == "pack" else {}
+        self.chunks = open_store(os.path.join(backupname, "glacier"), store, compression=compression, compression_level=compression_level, **options)
+        self.hashers = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1, thread_name_prefix="glacier-hash")
+        self.files = ThreadPoolExecutor(max_workers=max(1, parallel_files), thread_name_prefix="glacier-file")
+        self.submitted = {}  # item -> future
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, item):
+        """Start archiving backupname/item in the background. Returns its future; submitting the same item again is a no-op."""
+        with self.lock:
+            if item not in self.submitted:
+                self.submitted[item] = self.files.submit(glacier_file, os.path.join(self.backupname, item),
+                    os.path.join(self.backupname, "glacier", "history", item), os.path.join(self.backupname, "glacier", "index", item),
+                    self.chunks, self.hashers, self.window, self.incremental, self.chunker, self.manifest_format, self.record_lengths)
+            return self.submitted[item]
+
+    def finish(self, items=None):
+        """Archive every image that hasn't been submitted yet, wait for all of them, and commit the manifests.
+
+        items limits the pass to those images; anything else keeps the manifest it already has. By default it's every image."""
+        try:
+            if items is None:
+                items = [item for item in os.listdir(self.backupname) if os.path.isfile(os.path.join(self.backupname, item))]
+            for item in sorted(items):
+                self.submit(item)
+            # result() re-raises anything that went wrong in a worker
+            for future in list(self.submitted.values()):
+                future.result()
+        finally:
+            self.close()
+
+        commit_snapshot(f"{self.backupname}/glacier/history")
+
+        # cull retention
+        if self.apply_retention:
+            apply_retention(f"{self.backupname}/glacier/history", self.retention_policies)
+
+        # then get rid of the chunks that only culled snapshots were using
+        if self.collect_garbage:
+            collect_garbage(os.path.join(self.backupname, "glacier"))
+
+    def close(self):
+        """Stop without committing. Manifests already written stay written; the next pass commits them."""
+        if self.closed:
+            return
+        self.closed = True
+        self.files.shutdown(wait=True)
+        self.hashers.shutdown(wait=True)
+        # make sure every chunk the manifests point at is on disk before anything commits them
+        self.chunks.close()
+        self.lock_file.close()
+
+def do_glacier_pass(backupname, retention_policies, **options):
     # for every file in backupname, not recursively, break it into 1mb chunks, hash each chunk, store the chunk under backupname/chunks/hash, and append the hash to backupname/glacier/history
-    for item in os.listdir(backupname):
-        item_path = os.path.join(backupname, item)
-        history_file_path = os.path.join(backupname, "glacier", "history", item)
-        with open(history_file_path, 'w') as history_file:
-            if os.path.isfile(item_path):
-                for chunk in chunkify_file(item_path):
-                    hash = hash_chunk(chunk)
-                    store_chunk(chunk, hash, backupname)
-                    history_file.write(hash + '\n')
-
-    execute(f"git -C {backupname}/glacier/history add .")
-    execute(f"git -C {backupname}/glacier/history commit -m 'dosvob backup'")
-
-    # cull retention
-    # currently disabled
-    #clear_git_retention(f"{backupname}/glacier/history", retention_policies)
-
-    # later we'll start GC'ing it, but for now we're just going to leave it
+    # threads is the size of the hashing pool (default: one per core), parallel_files is how many images get processed at once,
+    # window is how many chunks each image is allowed to have in flight
+    # incremental uses the sidecar index in backupname/glacier/index to skip images that haven't changed
+    # store is "loose" for one file per chunk or "pack" for packfiles (see chunkstore.py)
+    # chunking is "fixed" for 1mb chunks or "cdc" for content-defined chunks between min_chunk and max_chunk
+    # compression is the codec new chunks get stored with: "none", "zlib", "lzma", or "zstd" (if the zstandard package is installed)
+    # manifest_format is "binary" (see manifest.py) or "text", the old one-hash-per-line format
+    # apply_retention deletes the snapshots retention_policies don't keep
+    # collect_garbage runs gc (see garbage.py) after the pass, deleting chunks no retained manifest uses
+    GlacierPass(backupname, retention_policies, **options).finish()
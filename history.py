@@ -0,0 +1,198 @@
+import datetime
+import os
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict
+from manifest import Manifest
+
+# The history repo: glacier/history is a git repo of manifests with one commit per glacier pass, so every version of a manifest is a blob.
+# Anything that wants old manifests reads them through here.
+#
+# Each snapshot's commit has no parent and is pointed at by its own ref, refs/snapshots/<UTC time>, so dropping a snapshot is just
+# deleting its ref, with no history to rewrite. HEAD follows the newest one so the checkout matches it. Repos from before this have
+# one long chain of commits on HEAD instead; those still read fine, and get converted the first time a snapshot is committed or pruned.
+
+snapshot_refs = "refs/snapshots/"
+
+def checked_out_manifests(repo_dir):
+    """Names of the manifests checked out in the history dir, leaving out git's own files and ones still being written."""
+    return sorted(name for name in os.listdir(repo_dir)
+        if not name.startswith('.') and not name.endswith('.tmp') and os.path.isfile(os.path.join(repo_dir, name)))
+
+def git(repo_dir, *args, input=None):
+    return subprocess.run(['git', '-C', repo_dir] + list(args), capture_output=True, check=True, text=True, input=input).stdout
+
+def snapshot_name(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d-%H%M%S")
+
+def _ref_number(ref):
+    parts = ref[len(snapshot_refs):].split('-')
+    return int(parts[2]) if len(parts) > 2 else 1
+
+def list_snapshots(repo_dir):
+    """(unix time, commit, ref) for every snapshot, oldest first. ref is None for the commits of an unconverted repo."""
+    refs = git(repo_dir, 'for-each-ref', '--format=%(authordate:unix) %(objectname) %(refname)', snapshot_refs)
+    if refs:
+        snapshots = []
+        for line in refs.splitlines():
+            timestamp, commit, ref = line.split()
+            snapshots.append((int(timestamp), commit, ref))
+        # snapshots from the same second get numbered refs; those sort after the first one
+        return sorted(snapshots, key=lambda snapshot: (snapshot[0], _ref_number(snapshot[2])))
+    try:
+        log = git(repo_dir, 'log', '--reverse', '--pretty=format:%at %H')
+    except subprocess.CalledProcessError:
+        # no commits yet
+        return []
+    return [(int(timestamp), commit, None) for timestamp, commit in (line.split() for line in log.splitlines())]
+
+def _unused_ref(repo_dir, timestamp, taken):
+    name = snapshot_name(timestamp)
+    ref = f"{snapshot_refs}{name}"
+    suffix = 1
+    while ref in taken:
+        suffix += 1
+        ref = f"{snapshot_refs}{name}-{suffix}"
+    taken.add(ref)
+    return ref
+
+def convert_to_snapshot_refs(repo_dir):
+    """Turn an old-style chain of commits into one parentless commit and ref per snapshot. Trees and dates stay the same."""
+    snapshots = list_snapshots(repo_dir)
+    if not snapshots or snapshots[0][2] is not None:
+        return
+    print(f"Converting {len(snapshots)} snapshots in {repo_dir} to snapshot refs")
+    taken = set()
+    updates = []
+    for timestamp, commit, ref in snapshots:
+        fields = git(repo_dir, 'show', '-s', '--format=%T%n%an%n%ae%n%ad%n%cn%n%ce%n%cd%n%B', '--date=raw', commit).split('\n', 7)
+        tree, author_name, author_email, author_date, committer_name, committer_email, committer_date, message = fields
+        environment = dict(os.environ, GIT_AUTHOR_NAME=author_name, GIT_AUTHOR_EMAIL=author_email, GIT_AUTHOR_DATE=author_date,
+            GIT_COMMITTER_NAME=committer_name, GIT_COMMITTER_EMAIL=committer_email, GIT_COMMITTER_DATE=committer_date)
+        new_commit = subprocess.run(['git', '-C', repo_dir, 'commit-tree', tree], capture_output=True, check=True, text=True,
+            input=message, env=environment).stdout.strip()
+        updates.append(f"create {_unused_ref(repo_dir, timestamp, taken)} {new_commit}\n")
+    git(repo_dir, 'update-ref', '--stdin', input="".join(updates))
+    git(repo_dir, 'update-ref', '-m', 'convert to snapshot refs', 'HEAD', new_commit)
+
+def commit_snapshot(repo_dir, message='dosvob backup'):
+    """Commit everything in the history dir as a new snapshot. Returns its ref."""
+    convert_to_snapshot_refs(repo_dir)
+    git(repo_dir, 'add', '-A', '.')
+    tree = git(repo_dir, 'write-tree').strip()
+    commit = git(repo_dir, 'commit-tree', tree, '-m', message).strip()
+    timestamp = int(git(repo_dir, 'show', '-s', '--format=%at', commit))
+    ref = _unused_ref(repo_dir, timestamp, set(ref for _, _, ref in list_snapshots(repo_dir)))
+    git(repo_dir, 'update-ref', ref, commit, '')
+    git(repo_dir, 'update-ref', '-m', message, 'HEAD', commit)
+    print(f"Committed snapshot {ref} ({commit})")
+    return ref
+
+def delete_snapshots(repo_dir, refs):
+    """Drop snapshots, and the manifests only they were using."""
+    if refs:
+        git(repo_dir, 'update-ref', '--stdin', input="".join(f"delete {ref}\n" for ref in refs))
+        # HEAD's reflog remembers every commit it ever pointed at, which would keep every deleted snapshot alive forever
+        git(repo_dir, 'reflog', 'expire', '--expire-unreachable=now', '--all')
+        # every manifest starts out as a loose object, so those go straight away; anything already packed goes when git next repacks
+        git(repo_dir, 'prune', '--expire=now')
+        git(repo_dir, '-c', 'gc.pruneExpire=now', 'gc', '--auto', '--quiet')
+
+class GitHistory(object):
+    """Every snapshot of the manifest repo, read straight out of git's object store, without checking anything out."""
+    def __init__(self, repo_dir, refresh_seconds=30):
+        self.repo_dir = repo_dir
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.refreshed = None
+        self.snapshot_list = OrderedDict()  # directory name -> commit, oldest first
+        self.commit_times = {}  # commit -> unix time
+        self.trees = {}  # commit -> { file name: blob id }
+        self.cat_file = None
+
+    def _git(self, *args):
+        return subprocess.run(['git', '-C', self.repo_dir] + list(args), capture_output=True, check=True).stdout
+
+    def snapshots(self):
+        """Directory name -> commit, oldest first. Names are the commit's UTC time, like the rest of dosvob's snapshot names."""
+        with self.lock:
+            if self.refreshed is None or time.monotonic() - self.refreshed > self.refresh_seconds:
+                snapshot_list = OrderedDict()
+                commit_times = {}
+                for timestamp, commit, ref in list_snapshots(self.repo_dir):
+                    name = snapshot_name(timestamp)
+                    if name in snapshot_list:
+                        name = f"{name}-{commit[:8]}"
+                    snapshot_list[name] = commit
+                    commit_times[commit] = timestamp
+                self.snapshot_list = snapshot_list
+                self.commit_times = commit_times
+                self.refreshed = time.monotonic()
+            return self.snapshot_list
+
+    def find(self, name):
+        """The commit for a snapshot directory name, or for a commit hash (or unambiguous prefix of one)."""
+        snapshots = self.snapshots()
+        if name in snapshots:
+            return snapshots[name]
+        if len(name) >= 4 and all(c in "0123456789abcdef" for c in name):
+            matches = [commit for commit in snapshots.values() if commit.startswith(name)]
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    def tree(self, commit):
+        """File name -> blob id for every manifest in a commit."""
+        with self.lock:
+            tree = self.trees.get(commit)
+        if tree is None:
+            tree = {}
+            for entry in self._git('ls-tree', '-z', commit).split(b'\0'):
+                if not entry:
+                    continue
+                info, name = entry.split(b'\t', 1)
+                mode, kind, blob = info.split()
+                if kind == b'blob':
+                    tree[name.decode()] = blob.decode('ascii')
+            # commits never change, so this never needs invalidating
+            with self.lock:
+                self.trees[commit] = tree
+        return tree
+
+    def retained_manifests(self, skip=()):
+        """Yields (key, Manifest) for every manifest that a snapshot or the checkout still uses. Committed manifests are keyed by blob id,
+        and one that's in several snapshots only comes up once; checked-out ones (which a pass that died before committing can leave
+        behind) are keyed "file:<name>". Keys in skip are left out."""
+        seen = set(skip)
+        for commit in self.snapshots().values():
+            for name, blob in self.tree(commit).items():
+                if blob not in seen:
+                    seen.add(blob)
+                    yield blob, Manifest.parse(self.read_blob(blob))
+        for name in checked_out_manifests(self.repo_dir):
+            if f"file:{name}" not in seen:
+                with open(os.path.join(self.repo_dir, name), 'rb') as f:
+                    yield f"file:{name}", Manifest.parse(f.read())
+
+    def read_blob(self, blob):
+        with self.lock:
+            # one long-lived cat-file process rather than a fork per blob
+            if self.cat_file is None or self.cat_file.poll() is not None:
+                self.cat_file = subprocess.Popen(['git', '-C', self.repo_dir, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.cat_file.stdin.write(f"{blob}\n".encode('ascii'))
+            self.cat_file.stdin.flush()
+            header = self.cat_file.stdout.readline().split()
+            if len(header) != 3 or header[1] != b'blob':
+                raise FileNotFoundError(f"Blob {blob} is missing from {self.repo_dir}")
+            data = self.cat_file.stdout.read(int(header[2]))
+            self.cat_file.stdout.read(1)
+            return data
+
+    def close(self):
+        with self.lock:
+            if self.cat_file is not None:
+                self.cat_file.stdin.close()
+                self.cat_file.wait()
+                self.cat_file = None
@@ -0,0 +1,241 @@
+import array
+import bisect
+import os
+import struct
+import sys
+
+# Manifests: the list of chunks that make up one image.
+#
+# There are two on-disk formats:
+#  * text: one line per chunk, either "hash" or "hash length"; all-zero chunks are "zero length". Easy to read, but 65+ bytes per chunk.
+#  * binary: a header followed by run-length-encoded runs of identical chunks, stored as parallel arrays so loading is just a few
+#    array.frombytes calls. An optional offset table holds the starting byte of every run, so it doesn't even need a pass to build.
+#
+# In memory, both turn into a Manifest, which keeps the runs in those same flat arrays and finds the chunk at any offset with a bisect.
+
+zero_hash = "zero"
+zero_digest = bytes(32)
+
+# chunk size of the original fixed chunking, which is the only thing that ever wrote manifest lines without lengths
+fixed_chunk_size = 1024*1024
+
+binary_magic = b"DVMF"
+binary_version = 1
+# magic, version, flags, run count, chunk count, total size
+binary_header = struct.Struct("<4sIIQQQ")
+flag_offsets = 1
+
+def _native(values):
+    # the format is little-endian; array is whatever the machine is
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+def _little(values):
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values
+
+class Manifest(object):
+    def __init__(self):
+        self.digests = bytearray()  # 32 bytes per run (a memoryview into the file's contents, for parsed manifests)
+        self.lengths = array.array('I')  # length of each chunk in the run
+        self.counts = array.array('I')  # how many chunks in the run
+        self.offsets = array.array('Q')  # byte offset each run starts at
+        self.chunk_count = 0
+        self.size = 0
+
+    def append(self, hash, length):
+        """Add a chunk to the end. hash is hex, or "zero" for an all-zero chunk."""
+        digest = zero_digest if hash == zero_hash else bytes.fromhex(hash)
+        if not isinstance(self.digests, bytearray):
+            # parsed manifests share the file's buffer; take a private copy before modifying it
+            self.digests = bytearray(self.digests)
+        runs = len(self.counts)
+        if runs and self.lengths[-1] == length and self.digests[-32:] == digest and self.counts[-1] < 0xffffffff:
+            self.counts[-1] += 1
+        else:
+            self.digests += digest
+            self.lengths.append(length)
+            self.counts.append(1)
+            self.offsets.append(self.size)
+        self.chunk_count += 1
+        self.size += length
+
+    def __len__(self):
+        return self.chunk_count
+
+    def run_hash(self, run):
+        digest = bytes(self.digests[run * 32:run * 32 + 32])
+        return zero_hash if digest == zero_digest else digest.hex()
+
+    def runs(self):
+        """Yields (hash, length, count) for every run."""
+        for run in range(len(self.counts)):
+            yield self.run_hash(run), self.lengths[run], self.counts[run]
+
+    def chunk_digests(self):
+        """Yields (raw digest, length) for every run that isn't all zeros. A length of 0 means the manifest doesn't say, which only
+        happens with old text manifests."""
+        for run in range(len(self.counts)):
+            digest = bytes(self.digests[run * 32:run * 32 + 32])
+            if digest != zero_digest:
+                yield digest, self.lengths[run]
+
+    def entries(self):
+        """Yields (hash, length) for every chunk."""
+        for hash, length, count in self.runs():
+            for _ in range(count):
+                yield hash, length
+
+    def hashes(self):
+        return [hash for hash, length in self.entries()]
+
+    def find(self, offset):
+        """Returns (hash, chunk start offset, chunk length) for the chunk containing offset, or None past the end."""
+        if offset < 0 or offset >= self.size:
+            return None
+        run = bisect.bisect_right(self.offsets, offset) - 1
+        length = self.lengths[run]
+        if length == 0:
+            raise ValueError("This manifest doesn't record chunk lengths, so it can't be searched by offset")
+        start = self.offsets[run] + (offset - self.offsets[run]) // length * length
+        return self.run_hash(run), start, length
+
+    def to_binary(self, offsets=True):
+        header = binary_header.pack(binary_magic, binary_version, flag_offsets if offsets else 0, len(self.counts), self.chunk_count, self.size)
+        parts = [header, bytes(self.digests), _little(self.lengths).tobytes(), _little(self.counts).tobytes()]
+        if offsets:
+            parts.append(_little(self.offsets).tobytes())
+        return b"".join(parts)
+
+    def to_text(self, record_lengths=True):
+        lines = []
+        for hash, length in self.entries():
+            # lengths are optional for ordinary chunks, but zero chunks need one
+            if record_lengths or hash == zero_hash:
+                lines.append(f"{hash} {length}\n")
+            else:
+                lines.append(hash + "\n")
+        return "".join(lines)
+
+    def write(self, path, format="binary", record_lengths=True):
+        """Atomically write the manifest to path."""
+        temp_path = f"{path}.tmp"
+        if format == "binary":
+            with open(temp_path, 'wb') as f:
+                f.write(self.to_binary())
+        elif format == "text":
+            with open(temp_path, 'w') as f:
+                f.write(self.to_text(record_lengths))
+        else:
+            raise ValueError(f"Unsupported manifest format: {format}")
+        os.replace(temp_path, path)
+
+    @classmethod
+    def parse(cls, data, resolve_length=None):
+        """Parse a manifest in either format.
+
+        Old text manifests don't always record chunk lengths. Those only ever came from fixed-size chunking, so every chunk but the
+        last is fixed_chunk_size, and resolve_length(hash) is called to find out how long the last one is. If resolve_length isn't
+        given, missing lengths are left as 0, which is fine for anything that only cares about the hashes."""
+        if data[:4] == binary_magic:
+            return cls._parse_binary(data)
+        return cls._parse_text(data.decode('ascii'), resolve_length)
+
+    @classmethod
+    def read_size(cls, path):
+        """Total image size from a binary manifest's header, without loading the rest of it. None for text manifests."""
+        with open(path, 'rb') as f:
+            header = f.read(binary_header.size)
+        if len(header) < binary_header.size or header[:4] != binary_magic:
+            return None
+        magic, version, flags, runs, chunk_count, size = binary_header.unpack(header)
+        return size
+
+    @classmethod
+    def _parse_binary(cls, data):
+        magic, version, flags, runs, chunk_count, size = binary_header.unpack_from(data)
+        if version != binary_version:
+            raise ValueError(f"Unsupported manifest version {version}")
+        manifest = cls()
+        position = binary_header.size
+        # no copy; the digests stay a view into data
+        manifest.digests = memoryview(data)[position:position + 32 * runs]
+        position += 32 * runs
+        manifest.lengths.frombytes(data[position:position + 4 * runs])
+        position += 4 * runs
+        manifest.counts.frombytes(data[position:position + 4 * runs])
+        position += 4 * runs
+        _native(manifest.lengths)
+        _native(manifest.counts)
+        if flags & flag_offsets:
+            manifest.offsets.frombytes(data[position:position + 8 * runs])
+            _native(manifest.offsets)
+        else:
+            total = 0
+            for length, count in zip(manifest.lengths, manifest.counts):
+                manifest.offsets.append(total)
+                total += length * count
+        manifest.chunk_count = chunk_count
+        manifest.size = size
+        if len(manifest.digests) != 32 * runs or len(manifest.counts) != runs or len(manifest.offsets) != runs:
+            raise ValueError("Truncated manifest")
+        return manifest
+
+    @classmethod
+    def _parse_text(cls, text, resolve_length):
+        manifest = cls()
+        lines = [fields for fields in (line.split() for line in text.splitlines()) if fields]
+        for index, fields in enumerate(lines):
+            if len(fields) > 1:
+                length = int(fields[1])
+            elif resolve_length is None:
+                length = 0
+            elif index == len(lines) - 1:
+                length = resolve_length(fields[0])
+            else:
+                length = fixed_chunk_size
+            manifest.append(fields[0], length)
+        return manifest
+
+    @classmethod
+    def load(cls, path, resolve_length=None):
+        with open(path, 'rb') as f:
+            return cls.parse(f.read(), resolve_length)
+
+def is_binary_manifest(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == binary_magic
+
+def convert_manifests(history_dir, glacier_dir=None, format="binary"):
+    """Rewrite every manifest in history_dir in the given format. Text manifests without lengths get them from the chunk store."""
+    from chunkstore import chunk_length, open_store
+
+    chunks = open_store(glacier_dir or os.path.dirname(os.path.abspath(history_dir)), readonly=True)
+
+    for name in sorted(os.listdir(history_dir)):
+        path = os.path.join(history_dir, name)
+        if not os.path.isfile(path) or name.endswith(".tmp"):
+            continue
+        if is_binary_manifest(path) == (format == "binary"):
+            continue
+        manifest = Manifest.load(path, lambda hash: chunk_length(chunks, hash))
+        before = os.path.getsize(path)
+        manifest.write(path, format)
+        print(f"{name}: {before} -> {os.path.getsize(path)} bytes")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert glacier manifests between the text and binary formats')
+    parser.add_argument('history_dir', type=str, help='Directory of manifests, usually backups/glacier/history')
+    parser.add_argument('--to', choices=['binary', 'text'], default='binary', help='Format to convert to')
+    parser.add_argument('--glacier-dir', type=str, default=None, help='Glacier directory holding the chunks; defaults to the parent of history_dir')
+
+    args = parser.parse_args()
+
+    convert_manifests(args.history_dir, args.glacier_dir, args.to)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+from urllib.parse import urlparse
+
+# Run metrics: how long every phase took (per volume and per region where it applies), every API call with its latency, and per volume,
+# how much diskrsync moved and what the glacier pass did with it. Everything records into the one module-level `metrics`, from any
+# thread. At the end of a run it becomes a JSON report, a Prometheus textfile (for node_exporter's textfile collector), and a short
+# summary for the healthchecks ping.
+
+# ids in API paths (numbers, uuids, hashes) would make every call its own endpoint
+id_segment = re.compile(r"^(\d+|[0-9a-f-]{16,})$")
+
+def endpoint_name(url):
+    """volumes/1234/actions -> volumes/{id}/actions. Works on relative paths and the full URLs pagination hands back."""
+    path = urlparse(url).path.strip('/')
+    if path.startswith("v2/"):
+        path = path[len("v2/"):]
+    return "/".join("{id}" if id_segment.match(segment) else segment for segment in path.split('/'))
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + "}"
+
+def write_atomically(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = []  # (name, labels, seconds), in the order they finished
+        self.api_calls = {}  # (method, endpoint, status) -> [count, seconds, max seconds]
+        self.volumes = {}  # volume -> counter -> value
+
+    def record_phase(self, name, seconds, **labels):
+        with self.lock:
+            self.phases.append((name, labels, seconds))
+
+    def record_api_call(self, method, url, status, seconds):
+        key = (method, endpoint_name(url), str(status))
+        with self.lock:
+            totals = self.api_calls.setdefault(key, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    def add(self, volume, **counters):
+        """Adds to a volume's counters; they're summed, so a volume that's retried or archived in pieces still adds up."""
+        with self.lock:
+            totals = self.volumes.setdefault(volume, {})
+            for counter, value in counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+
+    def volume_report(self, volume):
+        with self.lock:
+            counters = dict(self.volumes.get(volume, {}))
+            phases = {}
+            for name, labels, seconds in self.phases:
+                if labels.get('volume') == volume:
+                    phases[name] = phases.get(name, 0) + seconds
+        report = dict(counters, phases=phases)
+        # throughput of the transfer is the whole image, since diskrsync reads and compares all of it, not just what it copied
+        if counters.get('bytes_synced') and phases.get('transfer'):
+            report['transfer_mb_per_s'] = counters['bytes_synced'] / 1024 / 1024 / phases['transfer']
+        if counters.get('bytes_read') and phases.get('glacier'):
+            report['glacier_mb_per_s'] = counters['bytes_read'] / 1024 / 1024 / phases['glacier']
+        return report
+
+    def report(self, status="ok"):
+        finished = time.time()
+        with self.lock:
+            phases = [{ 'name': name, 'labels': labels, 'seconds': seconds } for name, labels, seconds in self.phases]
+            api_calls = sorted(self.api_calls.items())
+            volume_names = sorted(self.volumes.keys() | set(labels['volume'] for name, labels, seconds in self.phases if 'volume' in labels))
+        volumes = { volume: self.volume_report(volume) for volume in volume_names }
+        totals = {}
+        for report in volumes.values():
+            for counter, value in report.items():
+                if isinstance(value, (int, float)) and not counter.endswith("_per_s"):
+                    totals[counter] = totals.get(counter, 0) + value
+        return {
+            'status': status,
+            'started': datetime.datetime.utcfromtimestamp(self.started).isoformat() + "Z",
+            'finished': datetime.datetime.utcfromtimestamp(finished).isoformat() + "Z",
+            'seconds': finished - self.started,
+            'phases': phases,
+            'volumes': volumes,
+            'totals': totals,
+            'api': {
+                'calls': sum(count for key, (count, seconds, slowest) in api_calls),
+                'failed': sum(count for key, (count, seconds, slowest) in api_calls if not key[2].startswith(('1', '2', '3'))),
+                'seconds': sum(seconds for key, (count, seconds, slowest) in api_calls),
+                'endpoints': [{ 'method': method, 'endpoint': endpoint, 'status': status, 'count': count, 'seconds': seconds, 'max_seconds': slowest }
+                    for (method, endpoint, status), (count, seconds, slowest) in api_calls],
+            },
+        }
+
+    def summary(self, report=None):
+        """A few lines of the report, for the healthchecks ping."""
+        report = report or self.report()
+        totals = report['totals']
+        lines = [
+            f"{len(report['volumes'])} volumes in {report['seconds']:.0f}s",
+            f"synced {totals.get('bytes_synced', 0) / 1024 / 1024:.0f}mb, wrote {totals.get('bytes_written', 0) / 1024 / 1024:.0f}mb",
+            f"glacier: {totals.get('chunks_hashed', 0)} chunks hashed, {totals.get('chunks_stored', 0)} stored, "
+                f"{totals.get('chunks_deduped', 0)} deduped, {totals.get('bytes_stored', 0) / 1024 / 1024:.0f}mb added",
+            f"api: {report['api']['calls']} calls, {report['api']['failed']} failed, {report['api']['seconds']:.1f}s",
+        ]
+        slowest = sorted(report['phases'], key=lambda phase: phase['seconds'], reverse=True)[:5]
+        if slowest:
+            lines.append("slowest: " + ", ".join(f"{':'.join(map(str, phase['labels'].values())) + ' ' if phase['labels'] else ''}{phase['name']} "
+                f"{phase['seconds']:.0f}s" for phase in slowest))
+        return "\n".join(lines)
+
+    def prometheus(self, report=None):
+        """The report in Prometheus text format."""
+        report = report or self.report()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP dosvob_{name} {help}")
+            lines.append(f"# TYPE dosvob_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"dosvob_{name}{prometheus_labels(labels)} {value}")
+
+        metric("last_run_timestamp_seconds", "gauge", "When the last run finished.", [({}, f"{time.time():.0f}")])
+        metric("last_run_success", "gauge", "Whether the last run succeeded.", [({}, 1 if report['status'] == "ok" else 0)])
+        metric("last_run_seconds", "gauge", "How long the last run took.", [({}, f"{report['seconds']:.3f}")])
+        # a series can only appear once, so a phase that ran more than once with the same labels gets added up
+        phase_seconds = {}
+        for phase in report['phases']:
+            labels = tuple(sorted(dict(phase['labels'], phase=phase['name']).items()))
+            phase_seconds[labels] = phase_seconds.get(labels, 0) + phase['seconds']
+        metric("phase_seconds", "gauge", "How long each phase of the last run took.",
+            [(dict(labels), f"{seconds:.3f}") for labels, seconds in phase_seconds.items()])
+        metric("api_requests", "gauge", "API requests made in the last run.",
+            [({ 'method': call['method'], 'endpoint': call['endpoint'], 'status': call['status'] }, call['count']) for call in report['api']['endpoints']])
+        metric("api_request_seconds", "gauge", "Time spent waiting on API requests in the last run.",
+            [({ 'method': call['method'], 'endpoint': call['endpoint'], 'status': call['status'] }, f"{call['seconds']:.3f}")
+                for call in report['api']['endpoints']])
+        counters = sorted(set(counter for volume in report['volumes'].values() for counter, value in volume.items() if isinstance(value, (int, float))))
+        for counter in counters:
+            metric(f"volume_{counter}", "gauge", f"Per-volume {counter.replace('_', ' ')} in the last run.",
+                [({ 'volume': name }, volume[counter]) for name, volume in sorted(report['volumes'].items()) if counter in volume])
+        return "\n".join(lines) + "\n"
+
+    def write(self, report_path=None, prometheus_path=None, status="ok"):
+        """Writes the JSON report and/or the Prometheus textfile. Returns the report."""
+        report = self.report(status)
+        if report_path:
+            write_atomically(report_path, json.dumps(report, indent=2) + "\n")
+        if prometheus_path:
+            write_atomically(prometheus_path, self.prometheus(report))
+        return report
+
+metrics = Metrics()
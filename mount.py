@@ -2,91 +2,339 @@ import os
 import fuse
 from fuse import FUSE, Operations
 import errno
+import stat
+import threading
+
+from chunkstore import chunk_length, decode_chunk, open_store
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from history import GitHistory, checked_out_manifests
+from manifest import Manifest, zero_hash
+
+class FdCache(object):
+    """LRU of open chunk/pack file descriptors, so reads don't pay for an open and close every time.
+    fds are refcounted, so one that's in use by another FUSE thread never gets closed out from under it."""
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.fds = OrderedDict()  # path -> [fd, users]
+
+    def acquire(self, path):
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is None:
+                entry = [os.open(path, os.O_RDONLY), 0]
+                self.fds[path] = entry
+            self.fds.move_to_end(path)
+            entry[1] += 1
+            # evict after counting it as in use; if everything older is busy, it would otherwise be the one that goes
+            self._evict()
+            return entry[0]
+
+    def release(self, path):
+        with self.lock:
+            self.fds[path][1] -= 1
+
+    def _evict(self):
+        for path in list(self.fds):
+            if len(self.fds) <= self.max_open:
+                break
+            fd, users = self.fds[path]
+            if users == 0:
+                os.close(fd)
+                del self.fds[path]
+
+    def close(self):
+        with self.lock:
+            for fd, users in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+
+class BlockCache(object):
+    """LRU of whole decoded chunks, capped at max_bytes."""
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict()  # hash -> bytes
+        self.used = 0
+
+    def get(self, hash):
+        with self.lock:
+            block = self.blocks.get(hash)
+            if block is not None:
+                self.blocks.move_to_end(hash)
+            return block
+
+    def put(self, hash, block):
+        if len(block) > self.max_bytes:
+            return
+        with self.lock:
+            if hash in self.blocks:
+                return
+            self.blocks[hash] = block
+            self.used += len(block)
+            while self.used > self.max_bytes:
+                evicted_hash, evicted = self.blocks.popitem(last=False)
+                self.used -= len(evicted)
 
 class ConcatFS(Operations):
-    def __init__(self, source_dir):
+    def __init__(self, source_dir, glacier_dir=None, cache_bytes=256*1024*1024, readahead=4, max_open=256, manifest_cache_bytes=64*1024*1024, history=False):
         self.source_dir = source_dir
-        self.files = self._load_files()
-        self.file_sizes = self._get_file_sizes()
-
-    def _process_filename(self, filename):
-        return f"chunks/{filename[0:2]}/{filename}"
-    
-    def _load_files(self):
-        files = {}
-        for file_name in os.listdir(self.source_dir):
-            file_path = os.path.join(self.source_dir, file_name)
-            if os.path.isfile(file_path):
-                with open(file_path, 'r') as f:
-                    hashes = [self._process_filename(line.strip()) for line in f]
-                files[file_name] = hashes
-        return files
-
-    def _get_file_sizes(self):
-        file_sizes = {}
-        for file_name, files in self.files.items():
-            cumulative_sizes = []
-            total_size = 0
-            for file_path in files:
-                file_size = os.path.getsize(file_path)
-                cumulative_sizes.append((total_size, total_size + file_size, file_path))
-                total_size += file_size
-            file_sizes[file_name] = cumulative_sizes
-        return file_sizes
+        # manifests live in glacier/history, so by default the chunks are right next door
+        self.chunks = open_store(glacier_dir or os.path.dirname(os.path.abspath(source_dir)), readonly=True)
+
+        # In history mode, the root has a directory per snapshot (plus "current" for the checked-out manifests), and any commit hash
+        # works as a directory name too. Otherwise it's just the checked-out manifests.
+        self.history = GitHistory(source_dir) if history else None
+
+        # Nothing gets loaded up front, so mounting is instant. Sizes come from manifest headers the first time something stats a file,
+        # and chunk tables are only parsed when a file is actually read. Both are keyed on what the manifest contains - the file's
+        # name and mtime for checked-out manifests, so they notice when a backup rewrites one, or the blob id for ones out of git,
+        # so identical manifests in different snapshots share one parsed copy.
+        self.sizes = {}  # key -> size
+        self.manifests = OrderedDict()  # key -> Manifest, least recently used first
+        self.manifest_cache_bytes = manifest_cache_bytes
+        self.manifests_lock = threading.Lock()
+
+        self.fds = FdCache(max_open)
+        self.blocks = BlockCache(cache_bytes)
+        # hash -> location; loose chunks cost a stat to locate, so remember where things are
+        self.locations = OrderedDict()
+        self.locations_lock = threading.Lock()
+
+        # readahead: when a file is being read sequentially, pull the next few chunks into the block cache in the background
+        self.readahead = readahead
+        self.prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="readahead") if readahead > 0 else None
+        self.prefetching = set()
+        self.last_read_end = {}  # path -> where the last read stopped
+
+    def _manifest_path(self, file_name):
+        # the history dir is a git repo, so there's a .git in there we don't want to show
+        if not file_name or '/' in file_name or file_name.startswith('.') or file_name.endswith('.tmp'):
+            raise fuse.FuseOSError(errno.ENOENT)
+        return os.path.join(self.source_dir, file_name)
+
+    def _stat_manifest(self, file_name):
+        try:
+            st = os.stat(self._manifest_path(file_name))
+        except FileNotFoundError:
+            raise fuse.FuseOSError(errno.ENOENT)
+        if not stat.S_ISREG(st.st_mode):
+            raise fuse.FuseOSError(errno.ENOENT)
+        return st
+
+    def _checked_out(self, file_name):
+        st = self._stat_manifest(file_name)
+        manifest_path = self._manifest_path(file_name)
+        def load():
+            with open(manifest_path, 'rb') as f:
+                return f.read()
+        return ("file", file_name, st.st_mtime_ns), st.st_mtime, load, manifest_path
+
+    def _resolve(self, path):
+        """Works out what a path refers to. Returns None for a directory, or (key, mtime, load, manifest path) for a manifest:
+        key identifies the manifest's contents, load() returns its bytes, and the path is only set for checked-out manifests."""
+        parts = [part for part in path.split('/') if part]
+        if self.history is None:
+            if not parts:
+                return None
+            if len(parts) == 1:
+                return self._checked_out(parts[0])
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        if len(parts) == 0:
+            return None
+        if parts[0] == "current":
+            if len(parts) == 1:
+                return None
+            if len(parts) == 2:
+                return self._checked_out(parts[1])
+            raise fuse.FuseOSError(errno.ENOENT)
+        commit = self.history.find(parts[0])
+        if commit is None or len(parts) > 2:
+            raise fuse.FuseOSError(errno.ENOENT)
+        if len(parts) == 1:
+            return None
+        blob = self.history.tree(commit).get(parts[1])
+        if blob is None:
+            raise fuse.FuseOSError(errno.ENOENT)
+        return ("blob", blob), self.history.commit_times.get(commit, 0), lambda: self.history.read_blob(blob), None
+
+    def _manifest_cost(self, manifest):
+        return len(manifest.digests) + 16 * len(manifest.counts)
+
+    def _manifest(self, path):
+        """The parsed manifest for a path, loading it if it isn't cached."""
+        resolved = self._resolve(path)
+        if resolved is None:
+            raise fuse.FuseOSError(errno.EISDIR)
+        key, mtime, load, manifest_path = resolved
+        with self.manifests_lock:
+            cached = self.manifests.get(key)
+            if cached is not None:
+                self.manifests.move_to_end(key)
+                return cached
+
+        manifest = Manifest.parse(load(), lambda hash: chunk_length(self.chunks, hash))
+
+        with self.manifests_lock:
+            self.manifests[key] = manifest
+            self.manifests.move_to_end(key)
+            self.sizes[key] = manifest.size
+            # evict idle manifests, but never the one we're about to hand back
+            used = sum(self._manifest_cost(loaded) for loaded in self.manifests.values())
+            while used > self.manifest_cache_bytes and len(self.manifests) > 1:
+                evicted_key, evicted = self.manifests.popitem(last=False)
+                used -= self._manifest_cost(evicted)
+        return manifest
+
+    def _size(self, path, resolved):
+        key, mtime, load, manifest_path = resolved
+        size = self.sizes.get(key)
+        if size is not None:
+            return size
+        size = Manifest.read_size(manifest_path) if manifest_path is not None else None
+        if size is None:
+            # text manifests don't have a header, and git blobs come out whole anyway, so parse it
+            return self._manifest(path).size
+        self.sizes[key] = size
+        return size
 
     def getattr(self, path, fh=None):
-        if path == '/':
+        resolved = self._resolve(path)
+        if resolved is None:
             st = dict(st_mode=(0o40755), st_nlink=2)
             return st
-        file_name = path.lstrip('/')
-        if file_name in self.file_sizes:
-            total_size = self.file_sizes[file_name][-1][1]
-            st = dict(st_mode=(0o100444), st_nlink=1, st_size=total_size)
-            return st
-        raise fuse.FuseOSError(errno.ENOENT)
+        key, mtime, load, manifest_path = resolved
+        st = dict(st_mode=(0o100444), st_nlink=1, st_size=self._size(path, resolved), st_mtime=mtime)
+        return st
 
     def open(self, path, flags):
-        file_name = path.lstrip('/')
-        if file_name not in self.files:
-            raise fuse.FuseOSError(errno.ENOENT)
+        self._manifest(path)
         return 0
 
+    def _locate(self, hash):
+        with self.locations_lock:
+            location = self.locations.get(hash)
+            if location is not None:
+                self.locations.move_to_end(hash)
+                return location
+        location = self.chunks.locate(hash)
+        if location is None:
+            raise fuse.FuseOSError(errno.EIO)
+        with self.locations_lock:
+            self.locations[hash] = location
+            if len(self.locations) > 65536:
+                self.locations.popitem(last=False)
+        return location
+
+    def _pread(self, file_path, length, offset):
+        fd = self.fds.acquire(file_path)
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            self.fds.release(file_path)
+
+    def _load_chunk(self, hash):
+        """The whole decoded chunk, through the block cache."""
+        block = self.blocks.get(hash)
+        if block is None:
+            file_path, file_offset, stored_size, codec = self._locate(hash)
+            block = decode_chunk(codec, self._pread(file_path, stored_size, file_offset))
+            self.blocks.put(hash, block)
+        return block
+
+    def _prefetch(self, manifest, offset):
+        """Queue the chunks starting at offset for loading into the block cache."""
+        for _ in range(self.readahead):
+            found = manifest.find(offset)
+            if found is None:
+                return
+            hash, start, length = found
+            offset = start + length
+            if hash == zero_hash or hash in self.prefetching or self.blocks.get(hash) is not None:
+                continue
+            self.prefetching.add(hash)
+            self.prefetcher.submit(self._prefetch_chunk, hash)
+
+    def _prefetch_chunk(self, hash):
+        try:
+            self._load_chunk(hash)
+        except Exception:
+            # it's only a guess; if it fails, the real read will report it
+            pass
+        finally:
+            self.prefetching.discard(hash)
+
+    def _read_chunk_range(self, hash, start, length, sequential):
+        """length bytes from start within one chunk."""
+        if hash == zero_hash:
+            # nothing on disk at all, make them up
+            return bytes(length)
+        block = self.blocks.get(hash)
+        if block is None:
+            file_path, file_offset, stored_size, codec = self._locate(hash)
+            if codec == "none" and not sequential:
+                # random access to a raw chunk: just grab the bytes we need
+                return self._pread(file_path, length, file_offset + start)
+            # compressed chunks have to be decoded whole, and a sequential reader is going to want the rest of it anyway
+            block = self._load_chunk(hash)
+        return block[start:start + length]
+
     def read(self, path, size, offset, fh):
-        file_name = path.lstrip('/')
-        if file_name not in self.files:
-            raise fuse.FuseOSError(errno.ENOENT)
+        manifest = self._manifest(path)
 
-        data = bytearray()
-        remaining_size = size
+        sequential = self.last_read_end.get(path) == offset
+        end_offset = min(offset + size, manifest.size)
+        self.last_read_end[path] = end_offset
+
+        pieces = []
         current_offset = offset
+        while current_offset < end_offset:
+            hash, start, length = manifest.find(current_offset)
+            piece = min(end_offset, start + length) - current_offset
+            pieces.append(self._read_chunk_range(hash, current_offset - start, piece, sequential))
+            current_offset += piece
+
+        if sequential and self.prefetcher is not None:
+            self._prefetch(manifest, end_offset)
 
-        for start, end, file_path in self.file_sizes[file_name]:
-            if current_offset < end:
-                with open(file_path, 'rb') as f:
-                    f.seek(current_offset - start)
-                    chunk = f.read(min(remaining_size, end - current_offset))
-                    data.extend(chunk)
-                    remaining_size -= len(chunk)
-                    if remaining_size <= 0:
-                        break
-            current_offset = max(current_offset, end)
+        return pieces[0] if len(pieces) == 1 else b"".join(pieces)
 
-        return bytes(data)
+    def destroy(self, path):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False)
+        self.fds.close()
+        if self.history is not None:
+            self.history.close()
 
     def readdir(self, path, fh):
-        if path == '/':
-            return ['.', '..'] + list(self.files.keys())
-        raise fuse.FuseOSError(errno.ENOENT)
+        if self._resolve(path) is not None:
+            raise fuse.FuseOSError(errno.ENOTDIR)
+        parts = [part for part in path.split('/') if part]
+        if self.history is None or parts == ["current"]:
+            return ['.', '..'] + checked_out_manifests(self.source_dir)
+        if not parts:
+            return ['.', '..', 'current'] + list(self.history.snapshots().keys())
+        return ['.', '..'] + sorted(self.history.tree(self.history.find(parts[0])).keys())
 
 def main():
     import argparse
-    parser = argparse.ArgumentParser(description='Expose files as virtual files based on SHA1 hashes in a directory')
-    parser.add_argument('source_dir', type=str, help='Directory containing files with SHA1 hashes')
+    parser = argparse.ArgumentParser(description='Expose glacier manifests as read-only virtual files')
+    parser.add_argument('source_dir', type=str, help='Directory containing manifests, usually backups/glacier/history')
     parser.add_argument('mount_point', type=str, help='Mount point for the virtual filesystem')
+    parser.add_argument('--glacier-dir', type=str, default=None, help='Glacier directory holding the chunks; defaults to the parent of source_dir')
+    parser.add_argument('--cache-mb', type=int, default=256, help='Memory to spend caching decoded chunks')
+    parser.add_argument('--readahead', type=int, default=4, help='Chunks to read ahead when a file is being read sequentially; 0 to disable')
+    parser.add_argument('--max-open', type=int, default=256, help='Chunk and pack files to keep open at once')
+    parser.add_argument('--manifest-cache-mb', type=int, default=64, help='Memory to spend keeping parsed manifests around')
+    parser.add_argument('--history', action='store_true', help='Expose every snapshot in the history repo as /<date>/<volume> (or /<commit>/<volume>), plus /current')
 
     args = parser.parse_args()
 
-    fuse = FUSE(ConcatFS(args.source_dir), args.mount_point, foreground=True, allow_other=True)
+    filesystem = ConcatFS(args.source_dir, args.glacier_dir, cache_bytes=args.cache_mb * 1024 * 1024, readahead=args.readahead, max_open=args.max_open,
+                          manifest_cache_bytes=args.manifest_cache_mb * 1024 * 1024, history=args.history)
+    fuse = FUSE(filesystem, args.mount_point, foreground=True, allow_other=True)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+import collections
+import ctypes
+import ctypes.util
+import functools
+import os
+import stat
+import threading
+import time
+
+from chunkstore import chunk_length, decode_chunk, open_store
+from concurrent.futures import ThreadPoolExecutor
+from history import GitHistory
+from manifest import Manifest, zero_hash
+
+# Restore: write an image back out of the glacier, from the current manifest or any snapshot's, to a file or a block device.
+#
+# Chunks are read and decoded on a thread pool, a window ahead of the writer, and the writer coalesces them into big sequential writes.
+# Zero chunks are left as holes in a fresh file. With --diff, the target is read first and only the chunks that differ get written, which
+# makes refreshing an old restore (or a device that mostly matches already) cost reads instead of writes.
+
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+def punch_hole(fd, offset, length):
+    """Turn a range of a file back into a hole. Returns False if the filesystem can't, in which case the caller writes zeros."""
+    if not hasattr(libc, "fallocate"):
+        return False
+    return libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, ctypes.c_long(offset), ctypes.c_long(length)) == 0
+
+def load_manifest(glacier_dir, name, snapshot=None, resolve_length=None):
+    """The manifest for an image, as checked out, or as of a snapshot (a snapshot name like 20240131-040000, or a commit hash)."""
+    history_dir = os.path.join(glacier_dir, "history")
+    if snapshot is None:
+        return Manifest.load(os.path.join(history_dir, name), resolve_length)
+    history = GitHistory(history_dir, refresh_seconds=0)
+    try:
+        commit = history.find(snapshot)
+        if commit is None:
+            raise FileNotFoundError(f"No snapshot {snapshot} in {history_dir}")
+        blob = history.tree(commit).get(name)
+        if blob is None:
+            raise FileNotFoundError(f"Snapshot {snapshot} has no {name}")
+        return Manifest.parse(history.read_blob(blob), resolve_length)
+    finally:
+        history.close()
+
+class Restorer(object):
+    def __init__(self, glacier_dir, threads=None, window=64, buffer_size=8*1024*1024):
+        self.chunks = open_store(glacier_dir, readonly=True)
+        self.threads = threads or os.cpu_count() or 1
+        self.window = window
+        self.buffer_size = buffer_size
+        # packs get read all over, so keep them open; loose chunks get opened and closed as needed
+        self.pack_fds = {}
+        self.pack_fds_lock = threading.Lock()
+        # runs of the same chunk (and chunks repeated nearby) only get read and decoded once
+        self.decoded = functools.lru_cache(maxsize=32)(self._decode)
+
+    def _decode(self, hash):
+        location = self.chunks.locate(hash)
+        if location is None:
+            raise FileNotFoundError(f"Chunk {hash} is missing from the store")
+        path, offset, length, codec = location
+        if path.endswith(".pack"):
+            with self.pack_fds_lock:
+                fd = self.pack_fds.get(path)
+                if fd is None:
+                    fd = self.pack_fds[path] = os.open(path, os.O_RDONLY)
+            payload = os.pread(fd, length, offset)
+        else:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        return decode_chunk(codec, payload)
+
+    def _fetch(self, hash, offset, length, target_fd, diff, sparse):
+        """What needs doing at offset: None if nothing, b"" to punch a hole, or the bytes to write."""
+        if hash == zero_hash:
+            if diff:
+                existing = os.pread(target_fd, length, offset)
+                if existing.count(0) == len(existing) and len(existing) == length:
+                    return None
+                return b"" if sparse else bytes(length)
+            # a fresh file is all holes already; a device needs the zeros written
+            return None if sparse else bytes(length)
+        data = self.decoded(hash)
+        if len(data) != length:
+            raise ValueError(f"Chunk {hash} is {len(data)} bytes, the manifest says {length}")
+        if diff and os.pread(target_fd, length, offset) == data:
+            return None
+        return data
+
+    def restore(self, manifest, target, diff=False):
+        """Write the image manifest describes to target. Returns (bytes written, bytes skipped)."""
+        is_device = os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode)
+        flags = os.O_RDWR if diff else os.O_WRONLY
+        if not is_device:
+            flags |= os.O_CREAT
+        fd = os.open(target, flags, 0o644)
+        try:
+            if is_device:
+                device_size = os.lseek(fd, 0, os.SEEK_END)
+                if device_size < manifest.size:
+                    raise ValueError(f"{target} is {device_size} bytes, but the image is {manifest.size}")
+            else:
+                if not diff:
+                    # start from nothing, so everything we don't write is a hole
+                    os.ftruncate(fd, 0)
+                os.ftruncate(fd, manifest.size)
+
+            written = skipped = 0
+            buffer = []
+            buffer_offset = buffer_end = 0
+
+            def flush():
+                nonlocal buffer
+                if buffer:
+                    data = b"".join(buffer) if len(buffer) > 1 else buffer[0]
+                    view = memoryview(data)
+                    position = buffer_offset
+                    while view:
+                        count = os.pwrite(fd, view, position)
+                        view = view[count:]
+                        position += count
+                    buffer = []
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="restore") as pool:
+                in_flight = collections.deque()
+                entries = iter(manifest.entries())
+                offset = 0
+                exhausted = False
+                while True:
+                    while not exhausted and len(in_flight) < self.window:
+                        entry = next(entries, None)
+                        if entry is None:
+                            exhausted = True
+                            break
+                        hash, length = entry
+                        in_flight.append((offset, length, pool.submit(self._fetch, hash, offset, length, fd, diff, not is_device)))
+                        offset += length
+                    if not in_flight:
+                        break
+                    chunk_offset, length, future = in_flight.popleft()
+                    data = future.result()
+                    if data is None:
+                        skipped += length
+                        continue
+                    if not data:
+                        flush()
+                        if not punch_hole(fd, chunk_offset, length):
+                            data = bytes(length)
+                        else:
+                            written += length
+                            continue
+                    # coalesce into one big write whenever chunks land back to back
+                    if buffer and (chunk_offset != buffer_end or buffer_end - buffer_offset >= self.buffer_size):
+                        flush()
+                    if not buffer:
+                        buffer_offset = chunk_offset
+                    buffer.append(data)
+                    buffer_end = chunk_offset + length
+                    written += length
+                flush()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        print(f"{target}: wrote {written / 1024 / 1024:.0f}mb, skipped {skipped / 1024 / 1024:.0f}mb, "
+            f"{manifest.size / 1024 / 1024 / elapsed:.1f}mb/s")
+        return written, skipped
+
+    def close(self):
+        for fd in self.pack_fds.values():
+            os.close(fd)
+        self.chunks.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Write an image back out of the glacier')
+    parser.add_argument('glacier_dir', type=str, help='Glacier directory, usually backups/glacier')
+    parser.add_argument('name', type=str, help='Image to restore, named like its manifest in glacier/history')
+    parser.add_argument('target', type=str, help='File or block device to write it to')
+    parser.add_argument('--snapshot', type=str, default=None, help='Restore as of this snapshot (name or commit hash) instead of the latest')
+    parser.add_argument('--diff', action='store_true', help='Compare against what is already in target and only write chunks that differ')
+    parser.add_argument('--threads', type=int, default=None, help='Threads reading chunks; defaults to one per core')
+    parser.add_argument('--window', type=int, default=64, help='Chunks to read ahead of the writer')
+
+    args = parser.parse_args()
+
+    restorer = Restorer(args.glacier_dir, args.threads, args.window)
+    try:
+        manifest = load_manifest(args.glacier_dir, args.name, args.snapshot, lambda hash: chunk_length(restorer.chunks, hash))
+        restorer.restore(manifest, args.target, args.diff)
+    finally:
+        restorer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from glacier import apply_retention, kept_snapshots, parse_duration
+from history import commit_snapshot, convert_to_snapshot_refs, list_snapshots
+
+# the policies from conf.json.example
+policies = [
+    { "name": "recent", "last": 10 },
+    { "name": "daily", "frequency": "1 day", "duration": "1 week" },
+    { "name": "weekly", "frequency": "1 week", "duration": "1 month" },
+    { "name": "monthly", "frequency": "1 month", "duration": "1 year" },
+]
+
+now = datetime(2024, 6, 1)
+
+def filter_snapshots(snapshots, kept_ids, retention_policy, now):
+    """The frequency/duration half of the retention code this replaced, minus its debug output, to check the new one against."""
+    frequency = parse_duration(retention_policy['frequency'])
+    duration = parse_duration(retention_policy['duration'])
+    last_kept = None
+    last_seen = None
+    for snapshot in snapshots:
+        if now - snapshot[0] > duration:
+            break
+        if snapshot[1] in kept_ids:
+            last_kept = snapshot
+            last_seen = snapshot
+            continue
+        if last_kept is None or last_kept[0] - snapshot[0] > frequency:
+            if last_seen is None or last_seen == last_kept:
+                last_seen = snapshot
+            kept_ids.add(last_seen[1])
+            last_kept = last_seen
+        last_seen = snapshot
+    return kept_ids
+
+def random_history(rng, count):
+    """count snapshots going back from now, newest first, with the irregular gaps a cron job that sometimes fails leaves."""
+    timestamp = now
+    snapshots = []
+    for index in range(count):
+        timestamp -= timedelta(hours=rng.choice([1, 6, 24, 24, 24, 25, 48, 100]))
+        snapshots.append((timestamp, f"commit{index}"))
+    return snapshots
+
+class KeptSnapshotsTest(unittest.TestCase):
+    def test_matches_old_frequency_semantics(self):
+        rng = random.Random(1)
+        for trial in range(200):
+            snapshots = random_history(rng, rng.randint(0, 600))
+            chosen = rng.sample(policies, rng.randint(1, len(policies)))
+            chosen.sort(key=policies.index)
+            expected = set()
+            for policy in chosen:
+                if 'last' in policy:
+                    expected.update(commit for timestamp, commit in snapshots[:policy['last']])
+                else:
+                    filter_snapshots(snapshots, expected, policy, now)
+            self.assertEqual(kept_snapshots(snapshots, chosen, now), expected, chosen)
+
+    def test_last_keeps_the_newest(self):
+        # the old code took snapshots[-last:], which on a newest-first list is the oldest ones
+        snapshots = random_history(random.Random(2), 50)
+        kept = kept_snapshots(snapshots, [{ "last": 3 }], now)
+        self.assertEqual(kept, { "commit0", "commit1", "commit2" })
+
+    def test_daily_keeps_one_a_day(self):
+        snapshots = [(now - timedelta(hours=hours), f"commit{hours}") for hours in range(1, 24 * 10)]
+        kept = sorted((timestamp for timestamp, commit in snapshots if commit in kept_snapshots(snapshots, [policies[1]], now)), reverse=True)
+        self.assertEqual(len(kept), 7)
+        for newer, older in zip(kept, kept[1:]):
+            self.assertLessEqual(newer - older, timedelta(days=1))
+        self.assertLessEqual(now - kept[-1], timedelta(weeks=1))
+
+    def test_nothing_to_keep(self):
+        self.assertEqual(kept_snapshots([], policies, now), set())
+        old = [(now - timedelta(days=400 + day), f"commit{day}") for day in range(10)]
+        self.assertEqual(kept_snapshots(old, policies[1:], now), set())
+
+class GitRepoTest(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.update(GIT_AUTHOR_NAME="dosvob", GIT_AUTHOR_EMAIL="dosvob@localhost",
+            GIT_COMMITTER_NAME="dosvob", GIT_COMMITTER_EMAIL="dosvob@localhost")
+        self.git('init', '-q', '.')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.repo)
+
+    def git(self, *args):
+        return subprocess.run(['git', '-C', self.repo] + list(args), capture_output=True, check=True, text=True).stdout
+
+    def write_manifest(self, text):
+        with open(os.path.join(self.repo, "volume"), 'w') as f:
+            f.write(text)
+
+    def at(self, timestamp):
+        os.environ['GIT_AUTHOR_DATE'] = os.environ['GIT_COMMITTER_DATE'] = f"{int(timestamp.timestamp())} +0000"
+
+    def snapshot(self, timestamp):
+        self.write_manifest(f"manifest at {timestamp}\n")
+        self.at(timestamp)
+        with redirect_stdout(StringIO()):
+            return commit_snapshot(self.repo)
+
+    def retention(self, retention_policies, **kwargs):
+        with redirect_stdout(StringIO()):
+            return apply_retention(self.repo, retention_policies, now=now, **kwargs)
+
+    def test_apply_retention(self):
+        timestamps = [now - timedelta(days=day) for day in range(30, 0, -1)]
+        for timestamp in timestamps:
+            self.snapshot(timestamp)
+        self.assertEqual(self.retention([{ "last": 5 }], dry_run=True), 25)
+        self.assertEqual(len(list_snapshots(self.repo)), 30)
+        oldest_manifest = self.git('rev-parse', f"{list_snapshots(self.repo)[0][1]}:volume").strip()
+
+        self.assertEqual(self.retention([{ "last": 5 }]), 25)
+        snapshots = list_snapshots(self.repo)
+        self.assertEqual([datetime.fromtimestamp(timestamp) for timestamp, commit, ref in snapshots], timestamps[-5:])
+        self.assertEqual(self.git('rev-parse', 'HEAD').strip(), snapshots[-1][1])
+        # the deleted snapshots' manifests are gone from the object store, not just unreferenced
+        self.assertNotEqual(subprocess.run(['git', '-C', self.repo, 'cat-file', '-e', oldest_manifest], capture_output=True).returncode, 0)
+
+    def test_newest_is_always_kept(self):
+        for day in range(500, 490, -1):
+            self.snapshot(now - timedelta(days=day))
+        newest = list_snapshots(self.repo)[-1]
+        self.assertEqual(self.retention(policies[1:]), 9)
+        self.assertEqual(list_snapshots(self.repo), [newest])
+
+    def test_no_policies_deletes_nothing(self):
+        for day in range(500, 490, -1):
+            self.snapshot(now - timedelta(days=day))
+        self.assertEqual(self.retention([]), 0)
+        self.assertEqual(len(list_snapshots(self.repo)), 10)
+
+    def test_convert_to_snapshot_refs(self):
+        timestamps = [now - timedelta(days=day) for day in range(5, 0, -1)]
+        trees = []
+        for timestamp in timestamps:
+            self.write_manifest(f"manifest at {timestamp}\n")
+            self.at(timestamp)
+            self.git('add', '-A', '.')
+            self.git('commit', '-q', '-m', f"backup {timestamp}")
+            trees.append(self.git('rev-parse', 'HEAD^{tree}').strip())
+        self.assertEqual([ref for timestamp, commit, ref in list_snapshots(self.repo)], [None] * 5)
+
+        with redirect_stdout(StringIO()):
+            convert_to_snapshot_refs(self.repo)
+        snapshots = list_snapshots(self.repo)
+        self.assertEqual([datetime.fromtimestamp(timestamp) for timestamp, commit, ref in snapshots], timestamps)
+        for (timestamp, commit, ref), tree in zip(snapshots, trees):
+            self.assertTrue(ref.startswith("refs/snapshots/"))
+            self.assertEqual(self.git('rev-parse', f"{commit}^{{tree}}").strip(), tree)
+            self.assertEqual(self.git('show', '-s', '--format=%P', commit).strip(), "")
+        self.assertEqual(self.git('rev-parse', 'HEAD').strip(), snapshots[-1][1])
+
+        # converting twice does nothing
+        with redirect_stdout(StringIO()):
+            convert_to_snapshot_refs(self.repo)
+        self.assertEqual(list_snapshots(self.repo), snapshots)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,36 @@
-
+import contextlib
 import os
+import subprocess
+import time
+
+from metrics import metrics
+
 
-# Like os.system but with more output
+# Like os.system but with more output. Returns the command's resource usage, which is how we find out how much it wrote.
 def execute(cmd):
     print(cmd)
-    if os.system(cmd) != 0:
+    process = subprocess.Popen(cmd, shell=True)
+    pid, status, usage = os.wait4(process.pid, 0)
+    # we reaped it ourselves, so Popen has to be told
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
         raise RuntimeError
+    return usage
+
+# Times a phase of the run. Labels say what it was working on (volume=, region=); every phase ends up in the run report.
+@contextlib.contextmanager
+def phase(name, **labels):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        metrics.record_phase(name, elapsed, **labels)
+        print(f"{phase_title(name, labels)}: {elapsed:.1f}s")
+
+def phase_title(name, labels):
+    return ": ".join([str(value) for value in labels.values()] + [name])
+
+def print_timings():
+    for name, labels, elapsed in metrics.phases:
+        print(f"  {phase_title(name, labels):<40} {elapsed:8.1f}s")
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+from chunkstore import LooseStore, PackStore, decode_chunk
+from concurrent.futures import ThreadPoolExecutor
+from history import GitHistory
+
+# Scrub: read every chunk in the store back off the disk, check it still decodes and hashes to its name, and cross-check the store against
+# every manifest in the history repo. Reports chunks that manifests need but the store doesn't have (missing), chunks whose contents
+# don't match their name or length (corrupt), and chunks nothing uses (orphaned; gc would delete these).
+#
+# Chunks are read in on-disk order, packs first and then loose chunks, so the disk mostly streams. Reading happens on one thread and
+# decoding and hashing on a pool, with a bounded number of chunks in flight. Progress is checkpointed to glacier/verify-checkpoint, so an
+# interrupted scrub, or one that hit its time limit, carries on from where it stopped.
+
+checkpoint_seconds = 30
+
+class RateLimiter(object):
+    """Token bucket on bytes read, so a nightly scrub can't starve the backup of disk bandwidth."""
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last = time.monotonic()
+
+    def consume(self, count):
+        if not self.bytes_per_second:
+            return
+        now = time.monotonic()
+        # allow up to a second's worth of burst
+        self.allowance = min(self.bytes_per_second, self.allowance + (now - self.last) * self.bytes_per_second)
+        self.last = now
+        self.allowance -= count
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.bytes_per_second)
+
+def referenced_chunks(glacier_dir):
+    """digest -> chunk length for every chunk used by any snapshot in the history repo, or by a checked-out manifest. The length is None
+    if only old text manifests use the chunk, since they don't say."""
+    referenced = {}
+    history = GitHistory(os.path.join(glacier_dir, "history"), refresh_seconds=0)
+    try:
+        for key, manifest in history.retained_manifests():
+            for digest, length in manifest.chunk_digests():
+                # old text manifests don't record lengths, and parse as 0; that means unknown, so another manifest's length wins
+                if length or digest not in referenced:
+                    referenced[digest] = length or None
+    finally:
+        history.close()
+    return referenced
+
+def stored_chunks(glacier_dir):
+    """(position, digest, path, offset, stored length, codec) for every chunk in the store, in on-disk order. position sorts the same way,
+    and is what gets checkpointed."""
+    if os.path.isdir(os.path.join(glacier_dir, "packs")):
+        packs = PackStore(glacier_dir, readonly=True)
+        for digest, (pack, offset, length, codec) in sorted(packs.entries.items(), key=lambda entry: entry[1][:2]):
+            yield [0, pack, offset], digest, packs.pack_path(pack), offset, length, codec
+    # walk the directory rather than trusting chunks/index, so chunks the index doesn't know about get checked too
+    loose = LooseStore(glacier_dir, readonly=True)
+    for hash in loose.scan():
+        location = loose.locate(hash)
+        if location is not None:
+            path, offset, length, codec = location
+            yield [1, hash, 0], bytes.fromhex(hash), path, offset, length, codec
+
+def check_chunk(digest, payload, codec, expected_length):
+    """Returns None if the chunk is fine, otherwise what's wrong with it."""
+    try:
+        data = decode_chunk(codec, payload)
+    except Exception as e:
+        return f"doesn't decode as {codec}: {e}"
+    if hashlib.sha256(data).digest() != digest:
+        return "contents don't match its hash"
+    if expected_length is not None and len(data) != expected_length:
+        return f"is {len(data)} bytes, manifests say {expected_length}"
+    return None
+
+class Scrubber(object):
+    def __init__(self, glacier_dir, threads=None, window=64, max_mb_per_second=None, time_limit=None, restart=False):
+        self.glacier_dir = glacier_dir
+        self.checkpoint_path = os.path.join(glacier_dir, "verify-checkpoint")
+        self.threads = threads or os.cpu_count() or 1
+        self.window = window
+        self.limiter = RateLimiter(max_mb_per_second * 1024 * 1024 if max_mb_per_second else None)
+        self.deadline = time.monotonic() + time_limit if time_limit else None
+        self.restart = restart
+
+    def _load_checkpoint(self):
+        if self.restart:
+            return None
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_checkpoint(self, checkpoint):
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def run(self):
+        """Returns True if nothing is missing or corrupt."""
+        print("Reading manifests")
+        referenced = referenced_chunks(self.glacier_dir)
+        print(f"{len(referenced)} chunks referenced")
+
+        checkpoint = self._load_checkpoint() or { 'position': None, 'corrupt': {}, 'checked': 0, 'bytes': 0 }
+        if checkpoint['position'] is not None:
+            print(f"Resuming after {checkpoint['checked']} chunks")
+        corrupt = checkpoint['corrupt']  # hash -> problem
+
+        present = set()
+        orphaned = 0
+        pending = queue.Queue(maxsize=self.window)
+        stop = threading.Event()
+        errors = []
+
+        def reader():
+            nonlocal orphaned
+            try:
+                files = {}
+                for position, digest, path, offset, length, codec in stored_chunks(self.glacier_dir):
+                    present.add(digest)
+                    if digest not in referenced:
+                        orphaned += 1
+                    if checkpoint['position'] is not None and position <= checkpoint['position']:
+                        continue
+                    if stop.is_set():
+                        break
+                    self.limiter.consume(length)
+                    if path not in files:
+                        # packs stay open while we walk through them; loose chunks get closed straight away
+                        for open_file in files.values():
+                            open_file.close()
+                        files = { path: open(path, 'rb') }
+                    try:
+                        files[path].seek(offset)
+                        payload = files[path].read(length)
+                    except OSError as e:
+                        corrupt[digest.hex()] = f"can't be read: {e}"
+                        continue
+                    future = hashers.submit(check_chunk, digest, payload, codec, referenced.get(digest))
+                    while not stop.is_set():
+                        try:
+                            pending.put((position, digest, len(payload), future), timeout=1)
+                            break
+                        except queue.Full:
+                            pass
+                for open_file in files.values():
+                    open_file.close()
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                pending.put(None)
+
+        start = time.monotonic()
+        last_report = last_checkpoint = start
+        checked = bytes_read = 0
+        finished = True
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="verify-hash") as hashers:
+            read_thread = threading.Thread(target=reader, name="verify-reader", daemon=True)
+            read_thread.start()
+            try:
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        break
+                    position, digest, length, future = item
+                    problem = future.result()
+                    if problem is not None:
+                        corrupt[digest.hex()] = problem
+                        print(f"CORRUPT {digest.hex()}: {problem}")
+                    checked += 1
+                    bytes_read += length
+                    checkpoint['position'] = position
+
+                    now = time.monotonic()
+                    if now - last_report >= 10:
+                        print(f"{checked} chunks, {bytes_read / 1024 / 1024:.0f}mb, {bytes_read / 1024 / 1024 / (now - start):.1f}mb/s")
+                        last_report = now
+                    if now - last_checkpoint >= checkpoint_seconds:
+                        self._save_checkpoint(dict(checkpoint, checked=checkpoint['checked'] + checked, bytes=checkpoint['bytes'] + bytes_read))
+                        last_checkpoint = now
+                    if self.deadline is not None and now > self.deadline:
+                        finished = False
+                        break
+            finally:
+                stop.set()
+                # drain so the reader can't be stuck on a full queue
+                while read_thread.is_alive():
+                    try:
+                        pending.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                read_thread.join()
+
+        if errors:
+            raise errors[0]
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        print(f"Checked {checked} chunks, {bytes_read / 1024 / 1024:.0f}mb in {elapsed:.0f}s "
+            f"({bytes_read / 1024 / 1024 / elapsed:.1f}mb/s, {checked / elapsed:.0f} chunks/s)")
+
+        if not finished:
+            self._save_checkpoint(dict(checkpoint, checked=checkpoint['checked'] + checked, bytes=checkpoint['bytes'] + bytes_read))
+            print("Out of time; the next verify will carry on from here")
+            return not corrupt
+
+        missing = [digest.hex() for digest in referenced if digest not in present]
+        for hash in sorted(missing):
+            print(f"MISSING {hash}")
+        print(f"{len(missing)} missing, {len(corrupt)} corrupt, {orphaned} orphaned")
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return not missing and not corrupt
+
+def main():
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Check every stored chunk against its hash and every manifest against the store')
+    parser.add_argument('glacier_dir', type=str, help='Glacier directory, usually backups/glacier')
+    parser.add_argument('--threads', type=int, default=None, help='Hashing threads; defaults to one per core')
+    parser.add_argument('--max-mb-per-second', type=float, default=None, help='Limit how fast chunks are read off the disk')
+    parser.add_argument('--time-limit', type=float, default=None, help='Stop after this many seconds; the next run resumes')
+    parser.add_argument('--restart', action='store_true', help='Ignore any checkpoint and start from the beginning')
+
+    args = parser.parse_args()
+
+    ok = Scrubber(args.glacier_dir, args.threads, max_mb_per_second=args.max_mb_per_second, time_limit=args.time_limit, restart=args.restart).run()
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()